@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+from pretty import *
+import argparse
+import json
+import lasagne
+import networks
+import numpy
+import os
+import platform
+import sys
+import theano
+import theano.tensor as T
+import time
+
+# Measures how many images per second every network in experiment.py can
+# take, both for the forward pass alone and for a full training step
+# (forward, backward and Nesterov update), on synthetic batches. The
+# networks are built by networks.py, just as main.py builds them. Results
+# can be saved as a JSON baseline, and a later run compared against it to
+# catch slowdowns.
+
+FORMAT = 1
+TIMED = ('forward', 'train')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--network', help='networks to benchmark (default: all in experiment.py)', nargs='+', default=None)
+parser.add_argument('--cropsz', type=int, help='size of the crop the networks see', default=networks.CROPSZ)
+parser.add_argument('-m', '--momentum', type=float, help='momentum of the training step', default=0.9)
+parser.add_argument('-b', '--batchsize', type=int, help='batch sizes to benchmark', nargs='+', default=[32, 64, 128, 256])
+parser.add_argument('--imsz', type=int, help='size of the synthetic images', default=128)
+parser.add_argument('--dtype', help='pixel type of the synthetic images', choices=['float32', 'uint8'], default='float32')
+parser.add_argument('--categories', type=int, help='number of categories of the softmax head', default=100)
+parser.add_argument('-w', '--warmup', type=int, help='untimed calls before measuring', default=2)
+parser.add_argument('-r', '--repeat', type=int, help='timed calls per measurement', default=10)
+parser.add_argument('-o', '--output', help='write the results as JSON to this file', default=None)
+parser.add_argument('-c', '--compare', help='compare against the results in this JSON baseline', default=None)
+parser.add_argument('--threshold', type=float, help='flag throughput this fraction below the baseline as a regression', default=0.1)
+args = parser.parse_args()
+
+def build(name, batchsize):
+    input_var = T.tensor4('X', dtype=args.dtype)
+    target_var = T.ivector('y')
+    learning_rate = T.scalar('l')
+    flip_var = T.iscalar('f')
+    crop_var = T.ivector('c')
+
+    _, prepared = networks.prepare(input_var, args.cropsz, crop_var, flip_var)
+    network = networks.build(name, prepared, args.cropsz, batchsize, args.categories)
+
+    prediction = lasagne.layers.get_output(network)
+    loss = networks.loss(network, prediction, target_var)
+    params = lasagne.layers.get_all_params(network, trainable=True)
+    updates = lasagne.updates.nesterov_momentum(loss, params, learning_rate=learning_rate, momentum=args.momentum)
+    train_fn = theano.function([learning_rate, flip_var, crop_var, input_var, target_var], loss, updates=updates)
+
+    test_prediction = lasagne.layers.get_output(network, deterministic=True)
+    forward_fn = theano.function([input_var, flip_var, crop_var], test_prediction)
+    return forward_fn, train_fn
+
+def measure(call, batchsize):
+    for _ in range(args.warmup):
+        call()
+    rates = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        call()
+        rates.append(batchsize / (time.perf_counter() - start))
+    rates = numpy.array(rates)
+    return {
+        'images_per_second': float(numpy.mean(rates)),
+        'std': float(numpy.std(rates)),
+        'median': float(numpy.median(rates)),
+        'min': float(numpy.min(rates)),
+        'max': float(numpy.max(rates)),
+        'repeat': args.repeat,
+    }
+
+def compare(results, baseline):
+    section("Comparing against {}".format(args.compare))
+    regressions = 0
+    for name, sizes in sorted(results.items()):
+        for bs, modes in sorted(sizes.items(), key=lambda kv: int(kv[0])):
+            # an entry also records how long compiling took; only the
+            # timed modes are compared
+            for mode in TIMED:
+                now = modes.get(mode)
+                before = baseline.get(name, {}).get(bs, {}).get(mode)
+                if not before or not now:
+                    continue
+                ratio = now['images_per_second'] / before['images_per_second']
+                verdict = 'ok'
+                if ratio < 1 - args.threshold:
+                    verdict = 'REGRESSION'
+                    regressions += 1
+                elif ratio > 1 + args.threshold:
+                    verdict = 'faster'
+                task("{} b={} {}: {:.1f} -> {:.1f} images/s ({:+.1f}%) {}".format(
+                        name, bs, mode, before['images_per_second'],
+                        now['images_per_second'], (ratio - 1) * 100, verdict))
+    return regressions
+
+names = args.network or networks.names()
+for name in names:
+    if name not in networks.names():
+        print("No network {} found.".format(name))
+        sys.exit(1)
+
+rng = numpy.random.RandomState(0)
+center = numpy.zeros((2,), dtype=numpy.int32)
+center.fill(numpy.floor((args.imsz - args.cropsz)/2))
+lr = numpy.array(1e-6, dtype=theano.config.floatX)
+
+results = {}
+for name in names:
+    section("Benchmarking {}".format(name))
+    results[name] = {}
+    for bs in args.batchsize:
+        task("Batch size {}".format(bs))
+        X = rng.rand(bs, 3, args.imsz, args.imsz)
+        if args.dtype == 'uint8':
+            X = (X * 255).astype(numpy.uint8)
+        else:
+            X = X.astype(numpy.float32)
+        y = rng.randint(0, args.categories, bs).astype(numpy.int32)
+
+        start = time.perf_counter()
+        forward_fn, train_fn = build(name, bs)
+        entry = {'compile_seconds': time.perf_counter() - start}
+        entry['forward'] = measure(lambda: forward_fn(X, 1, center), bs)
+        entry['train'] = measure(lambda: train_fn(lr, 1, center, X, y), bs)
+        results[name][str(bs)] = entry
+        subtask("forward {:.1f} ± {:.1f} images/s, train {:.1f} ± {:.1f} images/s".format(
+                entry['forward']['images_per_second'], entry['forward']['std'],
+                entry['train']['images_per_second'], entry['train']['std']))
+
+report = {
+    'format': FORMAT,
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'host': platform.node(),
+    'cpus': os.cpu_count(),
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'theano': theano.__version__,
+    'lasagne': lasagne.__version__,
+    'floatX': theano.config.floatX,
+    'device': theano.config.device,
+    'imsz': args.imsz,
+    'cropsz': args.cropsz,
+    'momentum': args.momentum,
+    'dtype': args.dtype,
+    'warmup': args.warmup,
+    'results': results,
+}
+
+if args.output:
+    with open(args.output + '.tmp', 'w') as f:
+        json.dump(report, f, indent=1)
+    os.rename(args.output + '.tmp', args.output)
+    task("Wrote {}".format(args.output))
+
+if args.compare:
+    with open(args.compare, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('format') != FORMAT:
+        print("Baseline {} has format {}, expected {}".format(
+                args.compare, baseline.get('format'), FORMAT))
+        sys.exit(1)
+    regressions = compare(results, baseline['results'])
+    if regressions:
+        section("{} regressions beyond {:.0f}%".format(regressions, args.threshold * 100))
+        sys.exit(1)
@@ -0,0 +1,203 @@
+import concurrent.futures
+import json
+import numpy
+import os
+import os.path
+import pickle
+import re
+import struct
+
+# A checkpoint is one file: a magic line, the length of a JSON header, the
+# header itself, and then every parameter array as raw bytes, each starting
+# on an align-byte boundary, so that loading is a memmap per array rather
+# than an unpickle. The header records the epoch, the training and
+# validation history, and the dtype, shape and offset of every array.
+#
+# Checkpoints written before this format (a sequence of pickles, format 0
+# or 1) can still be read.
+
+MAGIC = b'PERISCOPE-CHECKPOINT\n'
+FORMAT = 2
+ALIGN = 64
+
+def save(fname, arrays, epoch, training, validation, extra=None):
+    '''Writes a checkpoint to fname.tmp and renames it into place. Anything
+    JSON can hold may be stored alongside as extra.'''
+    arrays = [numpy.ascontiguousarray(a) for a in arrays]
+    entries = []
+    offset = 0
+    for a in arrays:
+        entries.append({'dtype': a.dtype.str, 'shape': list(a.shape),
+                        'offset': offset})
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    header = json.dumps({
+        'format': FORMAT,
+        'epoch': epoch,
+        'training': [[float(v) for v in dp] for dp in training],
+        'validation': [[float(v) for v in dp] for dp in validation],
+        'params': entries,
+        'extra': extra,
+    }).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header)
+    start += (-start) % ALIGN
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for a, e in zip(arrays, entries):
+            f.seek(start + e['offset'])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, fname)
+
+def load(source, params=True):
+    '''Reads a checkpoint from a path or a file opened in binary mode.
+
+    Returns a dict with the format version, the epoch, the training and
+    validation histories and, if params is set, the list of parameter
+    arrays. Arrays of the current format are read-only memmaps of the file.
+    Formats 0 and 1 hold the trainable parameters only, or all of them.
+    '''
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return load(f, params)
+    source.seek(0)
+    if source.read(len(MAGIC)) != MAGIC:
+        return load_pickle(source)
+    size, = struct.unpack('<Q', source.read(8))
+    header = json.loads(source.read(size).decode('utf-8'))
+    start = len(MAGIC) + 8 + size
+    start += (-start) % ALIGN
+    result = {
+        'format': header['format'],
+        'epoch': header['epoch'],
+        'training': [tuple(dp) for dp in header['training']],
+        'validation': [tuple(dp) for dp in header['validation']],
+        'extra': header.get('extra'),
+    }
+    if params:
+        result['params'] = [
+            numpy.memmap(source.name, dtype=numpy.dtype(e['dtype']), mode='r',
+                         offset=start + e['offset'], shape=tuple(e['shape']))
+            if int(numpy.prod(e['shape'])) else
+            numpy.empty(e['shape'], dtype=numpy.dtype(e['dtype']))
+            for e in header['params']]
+    return result
+
+def load_pickle(f):
+    # add imports for unpickle to work
+    import lasagne
+    import theano
+    f.seek(0)
+    formatver = pickle.load(f)
+    if type(formatver) != int:
+        formatver = 0
+        f.seek(0)
+    state = pickle.load(f)
+    epoch = pickle.load(f)
+    training = pickle.load(f)
+    validation = pickle.load(f)
+    return {
+        'format': formatver,
+        'epoch': epoch,
+        'training': training,
+        'validation': validation,
+        'params': state,
+        'extra': None,
+    }
+
+def epochs(directory):
+    '''Returns a dict from epoch to checkpoint path for a run directory.'''
+    found = {}
+    for n in os.listdir(directory):
+        m = re.match(r'^epoch-(\d+)\.mdl$', n)
+        if m:
+            found[int(m.group(1))] = os.path.join(directory, n)
+    return found
+
+# Validation results of a run, whoever computed them, are kept next to its
+# checkpoints in validation.txt, one line "epoch loss acc1 acc5" per epoch.
+
+def results_name(directory):
+    return os.path.join(directory, 'validation.txt')
+
+def read_results(directory):
+    '''Returns a dict from epoch to (loss, top 1 acc, top 5 acc).'''
+    results = {}
+    try:
+        with open(results_name(directory), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 4:
+                    results[int(fields[0])] = tuple(float(v) for v in fields[1:])
+    except FileNotFoundError:
+        pass
+    return results
+
+def append_results(directory, results):
+    '''Appends the (epoch, (loss, top 1 acc, top 5 acc)) of results.'''
+    with open(results_name(directory), 'a') as f:
+        for epoch, result in results:
+            f.write('{}\t{}\t{}\t{}\n'.format(epoch, *result))
+
+def prune(directory, validation, last=0, best=False, every=0):
+    '''Deletes the checkpoints of a run that the retention policy doesn't
+    keep: the last last checkpoints, the one with the best top 1 validation
+    accuracy if best, and every every-th epoch; each rule that is given
+    keeps its checkpoints whatever the others do. Checkpoints whose epoch
+    has not been validated yet, or has NaN results, are always kept, and so
+    is the latest, to resume from. With no rule given, nothing is deleted.'''
+    if not (last or best or every):
+        return []
+    found = epochs(directory)
+    keep = set(sorted(found)[-max(last, 1):])
+    # an epoch recorded as NaN had no result, so may still be validated
+    validated = [e for e in range(len(validation))
+                 if not numpy.isnan(validation[e][1])]
+    keep.update(e for e in found if e not in validated)
+    if best and validated:
+        keep.add(max(validated, key=lambda e: validation[e][1]))
+    if every:
+        keep.update(e for e in found if (e + 1) % every == 0)
+    removed = []
+    for e in sorted(found):
+        if e not in keep:
+            try:
+                os.remove(found[e])
+                removed.append(found[e])
+            except FileNotFoundError:
+                pass
+    return removed
+
+class Writer(object):
+    '''Saves checkpoints on a background thread, one at a time and in the
+    order they were submitted. The arrays handed to save() must not change
+    afterwards; pass copies.'''
+
+    def __init__(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def save(self, fname, arrays, epoch, training, validation, extra=None,
+             after=None):
+        self.check()
+        self.pending.append(self.pool.submit(self._save, fname, arrays,
+                epoch, list(training), list(validation), extra, after))
+
+    def _save(self, fname, arrays, epoch, training, validation, extra, after):
+        save(fname, arrays, epoch, training, validation, extra)
+        if after is not None:
+            after()
+
+    def check(self):
+        # Surface errors from earlier writes, and forget finished ones.
+        for f in [f for f in self.pending if f.done()]:
+            self.pending.remove(f)
+            f.result()
+
+    def wait(self):
+        concurrent.futures.wait(self.pending)
+        self.check()
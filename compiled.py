@@ -0,0 +1,110 @@
+import hashlib
+import os
+import os.path
+import pickle
+import theano
+from theano.compile.sharedvalue import SharedVariable
+
+# Compiling the Theano functions of a big network takes minutes, most of it
+# spent optimizing the graph. A Function here is only compiled when it is
+# first called, and the compiled function is pickled into a cache, so that
+# the next run with the same setup only has to unpickle it. The cache key
+# covers the caller's key (network, batch size, crop size, ...), the Theano
+# version and config, and the source of the files that build the graph.
+#
+# A function pickles with its own copies of the shared variables it uses.
+# On load, those are swapped for the live ones of the current graph, which
+# are found in the same order by walking the graph the same way.
+
+def default_dir():
+    return os.path.join(theano.config.compiledir, 'periscope')
+
+def shared_variables(outputs, updates=(), givens=()):
+    graph = list(outputs)
+    for pair in list(updates) + list(givens):
+        graph.extend(pair)
+    return [v for v in theano.gof.graph.inputs(graph)
+            if isinstance(v, SharedVariable)]
+
+class Function(object):
+    '''Stands in for theano.function(inputs, outputs, **kwargs), compiled
+    on first use. With directory None, nothing is cached.'''
+
+    def __init__(self, name, key, inputs, outputs, directory=None,
+                 sources=(), **kwargs):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.kwargs = kwargs
+        self.directory = directory
+        self.fn = None
+        digest = hashlib.sha1()
+        digest.update(repr((name, key, theano.__version__)).encode('utf-8'))
+        digest.update(str(theano.config).encode('utf-8'))
+        for source in sources:
+            with open(source, 'rb') as f:
+                digest.update(f.read())
+        self.digest = digest.hexdigest()
+
+    def __call__(self, *args, **kwargs):
+        if self.fn is None:
+            self.compile()
+        return self.fn(*args, **kwargs)
+
+    def path(self):
+        return os.path.join(self.directory,
+                '{}-{}.pkl'.format(self.name, self.digest))
+
+    def live(self):
+        outputs = self.outputs
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        updates = self.kwargs.get('updates', ())
+        if hasattr(updates, 'items'):
+            updates = updates.items()
+        givens = self.kwargs.get('givens', ())
+        if hasattr(givens, 'items'):
+            givens = givens.items()
+        return shared_variables(outputs, updates, givens)
+
+    def compile(self):
+        if self.fn is not None:
+            return self.fn
+        live = self.live()
+        if self.directory is not None:
+            self.fn = self.load(live)
+        if self.fn is None:
+            self.fn = theano.function(self.inputs, self.outputs, **self.kwargs)
+            if self.directory is not None:
+                self.store(live)
+        return self.fn
+
+    def load(self, live):
+        try:
+            with open(self.path(), 'rb') as f:
+                fn, order = pickle.load(f)
+            stored = fn.get_shared()
+            if len(stored) != len(order) or max(order + [-1]) >= len(live):
+                return None
+            return fn.copy(swap={s: live[i] for s, i in zip(stored, order)})
+        except Exception:
+            # A missing, stale or unreadable entry is compiled afresh.
+            return None
+
+    def store(self, live):
+        order = []
+        for s in self.fn.get_shared():
+            index = [i for i, v in enumerate(live) if v is s]
+            if not index:
+                return
+            order.append(index[0])
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path(), os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((self.fn, order), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path())
+        except Exception:
+            # Some functions don't pickle; they are just not cached.
+            if os.path.exists(tmp):
+                os.remove(tmp)
@@ -0,0 +1,76 @@
+import numpy
+import os.path
+
+# Analyses of the predictions in a *.confusion.db file, which holds a row of
+# float32 category scores for every image of a set. Everything is computed
+# in chunks of rows, so that the file is read through once, a piece at a
+# time, without sorting every row.
+
+CHUNK = 8192
+
+def open_predictions(fname, cats):
+    '''Maps a confusion db read-only as an (images, cats) array.'''
+    count = os.path.getsize(fname) // (4 * cats)
+    return numpy.memmap(fname, dtype=numpy.float32, mode='r',
+                        shape=(count, cats))
+
+def chunks(cases, chunk=CHUNK):
+    for start in range(0, cases, chunk):
+        yield slice(start, min(start + chunk, cases))
+
+def ranks(predictions, labels, chunk=CHUNK):
+    '''The rank of the true label of every image among its scores: 0 when
+    the true label scores highest. Ties are ranked in favor of the true
+    label.'''
+    cases = len(predictions)
+    labels = numpy.asarray(labels[:cases], dtype=numpy.intp)
+    result = numpy.empty(cases, dtype=numpy.int32)
+    for s in chunks(cases, chunk):
+        block = predictions[s]
+        truth = block[numpy.arange(len(block)), labels[s]]
+        result[s] = (block > truth[:, None]).sum(axis=1)
+    return result
+
+def accuracy(ranks, k=10):
+    '''acc@1 through acc@k: the fraction of images whose true label is
+    among the top n scores, for n from 1 to k.'''
+    counts = numpy.bincount(ranks, minlength=k)[:k]
+    return numpy.cumsum(counts) / max(len(ranks), 1)
+
+def top(predictions, k=5, chunk=CHUNK):
+    '''The indexes and scores of the k highest scores of every image,
+    highest first.'''
+    cases, cats = predictions.shape
+    k = min(k, cats)
+    index = numpy.empty((cases, k), dtype=numpy.intp)
+    score = numpy.empty((cases, k), dtype=predictions.dtype)
+    for s in chunks(cases, chunk):
+        block = predictions[s]
+        rows = numpy.arange(len(block))[:, None]
+        part = numpy.argpartition(-block, k - 1, axis=1)[:, :k]
+        order = numpy.argsort(-block[rows, part], axis=1)
+        index[s] = part[rows, order]
+        score[s] = block[rows, index[s]]
+    return index, score
+
+def matrix(predictions, labels, chunk=CHUNK):
+    '''The confusion matrix: entry [t, p] counts the images of true
+    category t whose top score was category p.'''
+    cases, cats = predictions.shape
+    labels = numpy.asarray(labels[:cases], dtype=numpy.intp)
+    counts = numpy.zeros(cats * cats, dtype=numpy.int64)
+    for s in chunks(cases, chunk):
+        picked = numpy.argmax(predictions[s], axis=1)
+        counts += numpy.bincount(labels[s] * cats + picked,
+                                 minlength=cats * cats)
+    return counts.reshape(cats, cats)
+
+def most_confused(matrix, count=20):
+    '''The count most frequent mistakes in a confusion matrix, as a list
+    of (true, picked, images) triples, most frequent first.'''
+    off = matrix.copy()
+    numpy.fill_diagonal(off, 0)
+    flat = numpy.argsort(-off, axis=None, kind='stable')[:count]
+    cats = matrix.shape[1]
+    return [(int(f // cats), int(f % cats), int(off.flat[f]))
+            for f in flat if off.flat[f]]
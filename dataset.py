@@ -0,0 +1,160 @@
+import bisect
+import json
+import numpy
+import os
+import os.path
+
+# Every prepared image set is described by a small index file, written by
+# prepare.py, that records the pixel dtype, the image shape, the number of
+# images and categories, and how the images are split into shard files.
+# Each shard is a plain memmap of consecutive images and can be read on its
+# own.
+
+def index_name(tagged, subset):
+    return os.path.join(tagged, subset + '.index.json')
+
+def shard_name(subset, i):
+    return '{}.images-{:05d}.db'.format(subset, i)
+
+def make_header(subset, count, dtype, shape, categories, shard_size):
+    shards = []
+    for i, start in enumerate(range(0, count, shard_size)):
+        shards.append({
+            'file': shard_name(subset, i),
+            'start': start,
+            'stop': min(start + shard_size, count),
+        })
+    return {
+        'version': 1,
+        'count': count,
+        'dtype': numpy.dtype(dtype).name,
+        'shape': list(shape),
+        'categories': categories,
+        'shard_size': shard_size,
+        'labels': subset + '.labels.db',
+        'filenames': subset + '.filenames.txt',
+        'shards': shards,
+    }
+
+def write_header(tagged, subset, header):
+    iname = index_name(tagged, subset)
+    with open(iname + '.tmp', 'w') as f:
+        json.dump(header, f, indent=1)
+    os.rename(iname + '.tmp', iname)
+
+def legacy_header(tagged, subset):
+    # Sets prepared before the index existed are a single float32 or uint8
+    # file of 128x128 images, with the count given by the labels file.
+    imsz = 128
+    labels = numpy.memmap(os.path.join(tagged, subset + '.labels.db'),
+            dtype=numpy.int32, mode='r')
+    count = len(labels)
+    fname = subset + '.images.db'
+    dtype = numpy.float32
+    if os.path.getsize(os.path.join(tagged, fname)) == count * 3 * imsz * imsz:
+        dtype = numpy.uint8
+    header = make_header(subset, count, dtype, (3, imsz, imsz),
+            int(numpy.max(labels)) + 1 if count else None, max(count, 1))
+    header['shards'] = [{'file': fname, 'start': 0, 'stop': count}]
+    return header
+
+def read_header(tagged, subset):
+    try:
+        with open(index_name(tagged, subset), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return legacy_header(tagged, subset)
+
+def open_images(tagged, subset):
+    return Images(tagged, read_header(tagged, subset))
+
+def open_labels(tagged, subset):
+    return numpy.memmap(os.path.join(tagged, subset + '.labels.db'),
+            dtype=numpy.int32, mode='r')
+
+class Images(object):
+    '''Array-like view of a prepared image set spread over its shards.
+
+    Shards are mapped the first time they are indexed, so a reader that
+    only touches part of the set never maps the rest. Reads that stay
+    within one shard return a view of that shard's memmap; reads that
+    span shards are assembled into a fresh array.
+    '''
+
+    def __init__(self, tagged, header, mode='r', suffix=''):
+        self.tagged = tagged
+        self.header = header
+        self.mode = mode
+        self.suffix = suffix
+        self.dtype = numpy.dtype(header['dtype'])
+        self.shape = (header['count'],) + tuple(header['shape'])
+        self.categories = header['categories']
+        self.starts = [s['start'] for s in header['shards']]
+        self._shards = [None] * len(header['shards'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def path(self, i):
+        return os.path.join(self.tagged,
+                self.header['shards'][i]['file'] + self.suffix)
+
+    def shard(self, i):
+        if self._shards[i] is None:
+            s = self.header['shards'][i]
+            self._shards[i] = numpy.memmap(self.path(i), dtype=self.dtype,
+                    mode=self.mode,
+                    shape=(s['stop'] - s['start'],) + self.shape[1:])
+        return self._shards[i]
+
+    def locate(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('image {} out of range'.format(index))
+        i = bisect.bisect_right(self.starts, index) - 1
+        return i, index - self.starts[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[numpy.arange(start, stop, step)]
+            if stop <= start:
+                return numpy.empty((0,) + self.shape[1:], dtype=self.dtype)
+            i, offset = self.locate(start)
+            s = self.header['shards'][i]
+            if stop <= s['stop']:
+                return self.shard(i)[offset:offset + stop - start]
+            return numpy.concatenate([self.shard(i)[offset:],
+                                      self[s['stop']:stop]])
+        if isinstance(key, (int, numpy.integer)):
+            i, offset = self.locate(key)
+            return self.shard(i)[offset]
+        # An array of indices: gather one shard at a time.
+        key = numpy.asarray(key)
+        out = numpy.empty((len(key),) + self.shape[1:], dtype=self.dtype)
+        owner = numpy.searchsorted(self.starts, key, side='right') - 1
+        for i in numpy.unique(owner):
+            which = numpy.nonzero(owner == i)[0]
+            out[which] = self.shard(i)[key[which] - self.starts[i]]
+        return out
+
+    def read(self, start, stop, out):
+        '''Copies images start:stop into out, shard by shard, without
+        assembling them in an intermediate array first.'''
+        pos = start
+        while pos < stop:
+            i, offset = self.locate(pos)
+            n = min(stop, self.header['shards'][i]['stop']) - pos
+            out[pos - start:pos - start + n] = self.shard(i)[offset:offset + n]
+            pos += n
+
+    def __setitem__(self, index, value):
+        i, offset = self.locate(index)
+        self.shard(i)[offset] = value
+
+    def flush(self):
+        for m in self._shards:
+            if m is not None:
+                m.flush()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from pretty import *
+import argparse
+import json
+import lasagne
+import networks
+import numpy
+import os
+import sys
+import theano
+
+# Estimates, without compiling anything, what the networks in experiment.py
+# cost: for every layer the output shape, the parameters, the
+# multiply-accumulates (MACs) of a forward pass and the memory of its
+# output, for a batch of a given size. Layers without weights count one
+# operation per output element, or one per input element pooled over.
+#
+# A training step is taken to cost three forward passes for layers with
+# weights (the gradient with respect to the input and to the weights each
+# cost as much as the forward pass) and two for the others, plus the
+# Nesterov update of every trained parameter. Training keeps every
+# activation and its gradient, and a velocity and gradient for every
+# parameter; a forward pass needs only the largest input and output of a
+# layer at once. These are estimates for comparing networks against a
+# budget, not measurements; see benchmark.py and main.py --profile for
+# those.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--network', help='networks to estimate (default: all in experiment.py)', nargs='+', default=None)
+parser.add_argument('--cropsz', type=int, help='size of the crop the networks see', default=networks.CROPSZ)
+parser.add_argument('-b', '--batchsize', type=int, help='size of each mini batch', default=256)
+parser.add_argument('--categories', type=int, help='number of categories of the softmax head', default=100)
+parser.add_argument('--summary', help='only print the totals of each network', action='store_true')
+parser.set_defaults(summary=False)
+parser.add_argument('--max-gmacs', type=float, help='flag networks whose training step takes more GMACs than this', default=None)
+parser.add_argument('--max-mb', type=float, help='flag networks whose training step takes more MB than this', default=None)
+parser.add_argument('-o', '--output', help='write the estimates as JSON to this file', default=None)
+args = parser.parse_args()
+
+itemsize = numpy.dtype(theano.config.floatX).itemsize
+
+def count(shape):
+    return int(numpy.prod(shape))
+
+def macs(layer):
+    '''Forward MACs of layer for the whole batch, and whether it has weights.'''
+    out = count(layer.output_shape)
+    if isinstance(layer, lasagne.layers.InputLayer):
+        return 0, False
+    nonlinearity = getattr(layer, 'nonlinearity', None)
+    extra = out if nonlinearity not in (None, lasagne.nonlinearities.identity) else 0
+    if isinstance(layer, lasagne.layers.conv.BaseConvLayer):
+        groups = getattr(layer, 'num_groups', 1)
+        fan_in = layer.input_shape[1] // groups * count(layer.filter_size)
+        return out * fan_in + extra, True
+    if isinstance(layer, lasagne.layers.DenseLayer):
+        fan_in = count(layer.input_shape[1:])
+        return out * fan_in + extra, True
+    if hasattr(layer, 'pool_size'):
+        return count(layer.input_shape) + extra, False
+    if isinstance(layer, lasagne.layers.BatchNormLayer):
+        # normalize, then scale and shift
+        return 2 * out + extra, False
+    if isinstance(layer, lasagne.layers.DropoutLayer):
+        return out, False
+    if isinstance(layer, lasagne.layers.ConcatLayer):
+        return 0, False
+    return out + extra, False
+
+def estimate(name):
+    # an input layer of its own; nothing is computed
+    network = networks.build(name, None, args.cropsz, args.batchsize,
+            args.categories)
+    layers = []
+    for k, layer in enumerate(lasagne.layers.get_all_layers(network)):
+        forward, weighted = macs(layer)
+        params = sum(count(p.get_value(borrow=True).shape)
+                     for p in layer.get_params())
+        trainable = sum(count(p.get_value(borrow=True).shape)
+                        for p in layer.get_params(trainable=True))
+        inputs = getattr(layer, 'input_shapes', None) or \
+                 [getattr(layer, 'input_shape', None)]
+        layers.append({
+            'layer': '{}: {}'.format(k, type(layer).__name__),
+            'output_shape': list(layer.output_shape),
+            'params': params,
+            'trainable': trainable,
+            'forward_macs': forward,
+            'train_macs': forward * (3 if weighted else 2),
+            'output_bytes': count(layer.output_shape) * itemsize,
+            'input_bytes': sum(count(s) for s in inputs if s) * itemsize,
+        })
+    params = sum(l['params'] for l in layers)
+    trainable = sum(l['trainable'] for l in layers)
+    activations = sum(l['output_bytes'] for l in layers)
+    return {
+        'layers': layers,
+        'params': params,
+        'trainable': trainable,
+        'forward_macs': sum(l['forward_macs'] for l in layers),
+        # the update reads the gradient and velocity of every parameter
+        'train_macs': sum(l['train_macs'] for l in layers) + 3 * trainable,
+        'params_bytes': params * itemsize,
+        'forward_bytes': params * itemsize + max(
+            l['input_bytes'] + l['output_bytes'] for l in layers),
+        'train_bytes': (params + 2 * trainable) * itemsize + 2 * activations,
+    }
+
+def mb(n):
+    return n / 2**20
+
+def show(name, result):
+    if not args.summary:
+        print('{:<24} {:>22} {:>10} {:>10} {:>10} {:>9}'.format(
+                'layer', 'output', 'params', 'fwd MMAC', 'trn MMAC', 'out MB'))
+        for l in result['layers']:
+            print('{:<24} {:>22} {:>10} {:>10.1f} {:>10.1f} {:>9.1f}'.format(
+                    l['layer'], 'x'.join(str(d) for d in l['output_shape']),
+                    l['params'], l['forward_macs'] / 1e6,
+                    l['train_macs'] / 1e6, mb(l['output_bytes'])))
+    task("{}: {} parameters ({} trainable), {:.1f} MB".format(name,
+            result['params'], result['trainable'], mb(result['params_bytes'])))
+    subtask("forward: {:.2f} GMACs, {:.1f} MB".format(
+            result['forward_macs'] / 1e9, mb(result['forward_bytes'])))
+    subtask("training step: {:.2f} GMACs, {:.1f} MB".format(
+            result['train_macs'] / 1e9, mb(result['train_bytes'])))
+
+def over(result):
+    reasons = []
+    if args.max_gmacs is not None and result['train_macs'] / 1e9 > args.max_gmacs:
+        reasons.append('{:.2f} GMACs'.format(result['train_macs'] / 1e9))
+    if args.max_mb is not None and mb(result['train_bytes']) > args.max_mb:
+        reasons.append('{:.1f} MB'.format(mb(result['train_bytes'])))
+    return reasons
+
+names = args.network or networks.names()
+for name in names:
+    if name not in networks.names():
+        print("No network {} found.".format(name))
+        sys.exit(1)
+
+section("Estimating {} networks at batch size {}".format(len(names), args.batchsize))
+results = {}
+for name in names:
+    results[name] = estimate(name)
+    show(name, results[name])
+
+if args.max_gmacs is not None or args.max_mb is not None:
+    section("Budget")
+    for name in names:
+        reasons = over(results[name])
+        results[name]['over_budget'] = reasons
+        task("{}: {}".format(name, 'over budget ({})'.format(
+                ', '.join(reasons)) if reasons else 'ok'))
+
+if args.output:
+    report = {
+        'batchsize': args.batchsize,
+        'cropsz': args.cropsz,
+        'categories': args.categories,
+        'floatX': theano.config.floatX,
+        'results': results,
+    }
+    with open(args.output + '.tmp', 'w') as f:
+        json.dump(report, f, indent=1)
+    os.rename(args.output + '.tmp', args.output)
+    task("Wrote {}".format(args.output))
@@ -3,11 +3,14 @@
 from progressbar import ProgressBar
 from pretty import *
 import argparse
+import checkpoint
+import compiled
+import dataset
 import experiment
+import networks
+import profiling
 import lasagne
-import theano
 import theano.tensor as T
-import pickle
 import numpy
 import time
 import re
@@ -23,6 +26,9 @@ parser.add_argument('-b', '--batchsize', type=int, help='size of each mini batch
 parser.add_argument('-s', '--set', help='image set to evaluate on', choices=['test', 'val'], default='test')
 parser.add_argument('-l', '--labels', action='store_true', help='output category labels', default=False)
 parser.add_argument('-d', '--devkit', help='devkit directory containing categories.txt', default='mp-dev_kit')
+parser.add_argument('--no-function-cache', help='compile functions afresh, without the cache', action='store_false', dest='function_cache_on')
+parser.set_defaults(function_cache_on=True)
+parser.add_argument('--profile', type=int, help='profile evaluation for this many batches, write a per-layer report next to the model, and exit', default=0)
 parser.add_argument('-c', '--combine', help='combine the output of multiple cropflips', default=False, action='store_true')
 args = parser.parse_args()
 
@@ -32,69 +38,69 @@ if len(args.model) != 1 and not args.combine:
     print("Cannot evaluate on multiple models without combination", file=sys.stderr)
     sys.exit(1)
 
-imsz = 128
-cropsz = 117
-
-center = numpy.floor((imsz - cropsz)/2)
-crops = [0, center, imsz - cropsz - 1]
-flips = [False, True]
+cropsz = networks.CROPSZ
 
 section("Setup")
 task("Loading data")
 subtask("Loading categories")
-cats = numpy.max(numpy.memmap(os.path.join(args.tagged, "train.labels.db"), dtype=numpy.int32, mode='r'))+1
+cats = dataset.read_header(args.tagged, "train")['categories']
 subtask("Loading {} set".format(args.set))
-y_test = numpy.memmap(os.path.join(args.tagged, "{}.labels.db".format(args.set)), dtype=numpy.int32, mode='r')
-X_test = numpy.memmap(os.path.join(args.tagged, "{}.images.db".format(args.set)), dtype=numpy.float32, mode='r', shape=(len(y_test), 3, imsz, imsz))
+y_test = dataset.open_labels(args.tagged, args.set)
+X_test = dataset.open_images(args.tagged, args.set)
+imsz = X_test.shape[-1]
+
+center = numpy.floor((imsz - cropsz)/2)
+crops = [0, center, imsz - cropsz - 1]
+flips = [False, True]
 
 section("Constructing networks")
 ni = 0
-networks = []
+models = []
+profiles = []
 for m in args.model:
     task(m.name)
-    subtask("Building model and compiling functions")
+    subtask("Building model")
 
     # create Theano variables for input and target minibatch
-    input_var = T.tensor4('X')
+    input_var = T.tensor4('X', dtype=X_test.dtype)
 
-    # input layer is always the same
-    network = lasagne.layers.InputLayer((args.batchsize, 3, cropsz, cropsz), input_var)
+    # the images go in already cropped and flipped, so they are only scaled
+    scaled, _ = networks.prepare(input_var, cropsz, (0, 0), 1)
 
-    # import external network
-    if args.network[ni] not in experiment.__dict__:
+    if args.network[ni] not in networks.names():
         print("No network {} found.".format(args.network[ni]))
         import sys
         sys.exit(1)
 
-    # dispatch to user-defined network
-    network = experiment.__dict__[args.network[ni]](network, cropsz, args.batchsize)
+    # the same network as main.py trains
+    network = networks.build(args.network[ni], scaled, cropsz, args.batchsize, cats)
 
-    # Last softmax layer is always the same
-    from lasagne.nonlinearities import softmax
-    network = lasagne.layers.DenseLayer(network, cats, nonlinearity=softmax)
+    # let the profile tell which layer every op came from
+    kwargs = {}
+    if args.profile:
+        names = profiling.tag_layers(network)
+        kwargs['profile'] = profiling.stats()
+        profiles.append((names, kwargs['profile']))
 
     # create parameter update expressions
     params = lasagne.layers.get_all_params(network, trainable=True)
     saveparams = lasagne.layers.get_all_params(network)
 
     # Create an evaluation expression for testing.
-    networks.append(theano.function([input_var], [lasagne.layers.get_output(network, deterministic=True)]))
+    # (compiled on first use; models of the same network share a cache entry)
+    models.append(compiled.Function('evaluate',
+            (args.network[ni], args.batchsize, cropsz, X_test.dtype.name),
+            [input_var], [lasagne.layers.get_output(network, deterministic=True)],
+            directory=compiled.default_dir() if args.function_cache_on and not args.profile else None,
+            sources=[__file__, experiment.__file__, networks.__file__], **kwargs))
 
     # Load model parameters
     subtask("Restoring state from {}".format(m.name))
-    m.seek(0)
-    formatver = pickle.load(m)
-    if type(formatver) != int:
-        formatver = 0
-        m.seek(0)
-
-    # Load parameters
-    state = pickle.load(m)
-    pickle.load(m) # epoch
-    pickle.load(m) # training
-    pickle.load(m) # validation
+    stored = checkpoint.load(m)
+
     # Restore parameter values
-    fileparams = saveparams if formatver >= 1 else params
+    state = stored['params']
+    fileparams = saveparams if stored['format'] >= 1 else params
     assert len(fileparams) == len(state)
     for p, v in zip(fileparams, state):
         p.set_value(v)
@@ -114,20 +120,24 @@ cases = len(X_test)
 predictions = numpy.zeros((len(X_test), 5))
 
 test_batches = len(range(0, cases, args.batchsize))
+if args.profile:
+    test_batches = min(test_batches, args.profile)
 p = progress(test_batches)
 i = 0
 _preds = None
 if args.combine:
-    _preds = numpy.zeros((len(flips)*len(crops)*len(crops)*len(networks), args.batchsize, cats))
+    _preds = numpy.zeros((len(flips)*len(crops)*len(crops)*len(models), args.batchsize, cats))
 
 for inp in iterate_minibatches(X_test):
+    if i == test_batches:
+        break
     s = i * args.batchsize
     if s + args.batchsize > predictions.shape[0]:
         inp = inp[:predictions.shape[0] - s]
 
     if not args.combine:
         # center crop
-        predictions[s:s+len(inp), :] = numpy.argsort(networks[0](inp[:, :, center:center+cropsz, center:center+cropsz])[0])[:, -5:][:, ::-1]
+        predictions[s:s+len(inp), :] = numpy.argsort(models[0](inp[:, :, center:center+cropsz, center:center+cropsz])[0])[:, -5:][:, ::-1]
     else:
         config = 0
         _preds.fill(0)
@@ -141,8 +151,8 @@ for inp in iterate_minibatches(X_test):
                 for ycrop in crops:
                     cropped = inp[:, :, ycrop:ycrop+cropsz, xcrop]
 
-                    for network in networks:
-                        _preds[config, :len(inp), :] = network(cropped)[0]
+                    for model in models:
+                        _preds[config, :len(inp), :] = model(cropped)[0]
                         config += 1
 
         # take median across configurations
@@ -153,6 +163,21 @@ for inp in iterate_minibatches(X_test):
     i += 1
     p.update(i)
 
+if args.profile:
+    section("Profiling")
+    for k, (names, profile) in enumerate(profiles):
+        fname = os.path.join(os.path.dirname(args.model[k].name) or '.',
+                'profile-evaluate' + ('-{}'.format(k) if len(profiles) > 1 else ''))
+        rows = profiling.report(profile, names, i)
+        profiling.write(rows, fname, "{} evaluate on {} batches of {}".format(
+                args.network[k], i, args.batchsize))
+        task(args.model[k].name)
+        for r in rows[:5]:
+            subtask("{:5.1f}% {}".format(r['share'] * 100, r['layer']))
+        subtask("Report in {}.txt".format(fname))
+    import sys
+    sys.exit(0)
+
 filenames = [line.strip() for line in open(os.path.join(args.tagged,
         'test.filenames.txt')).readlines()]
 
@@ -0,0 +1,269 @@
+import concurrent.futures
+import numpy
+
+# Batches are assembled off the training thread, so that page faults on the
+# image shards and the copies that put a batch together overlap with the
+# work done on the previous batch.
+
+def aligned_empty(shape, dtype, align=64):
+    '''Like numpy.empty, but with the data starting on an align-byte boundary.'''
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    raw = numpy.empty(nbytes + align, dtype=numpy.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def read(source, start, stop, out):
+    if hasattr(source, 'read'):
+        source.read(start, stop, out)
+    else:
+        out[...] = source[start:stop]
+
+def drain(pending):
+    '''Cancels the reads of a dict of futures, and waits for those that
+    already started.'''
+    for f in pending.values():
+        f.cancel()
+    concurrent.futures.wait(list(pending.values()))
+    pending.clear()
+
+class Prefetcher(object):
+    '''Reads batches of (inputs, targets) ahead of the consumer.
+
+    Up to depth batches are assembled in the background by a pool of
+    threads, each into its own slot in a ring of buffers that is allocated
+    once and reused for every batch of every pass. A batch handed out by
+    batches() or shuffled() is only valid until the next one is requested;
+    copy it if it needs to live longer. With depth 0, every batch is read on demand, but
+    still into the same reusable buffer.
+
+    Only one pass is active at a time: starting a new one cancels the reads
+    the last one still has in flight and waits for them, and the last pass
+    raises if it is asked for another batch.
+    '''
+
+    def __init__(self, inputs, targets, batchsize, depth=4, threads=2):
+        assert len(inputs) == len(targets)
+        self.inputs = inputs
+        self.targets = targets
+        self.batchsize = batchsize
+        self.depth = depth
+        nbuf = depth + 1
+        self.X = aligned_empty((nbuf, batchsize) + tuple(inputs.shape[1:]), inputs.dtype)
+        self.y = aligned_empty((nbuf, batchsize), targets.dtype)
+        self.C = None
+        self.pool = None
+        self.serial = None
+        self.mixer = None
+        self.active = None
+        if depth > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def fill(self, buf, start, wrap):
+        # A batch that runs past the end either wraps around to the start
+        # of the set, or is cut short.
+        end = len(self.inputs)
+        stop = min(start + self.batchsize, end)
+        n = stop - start
+        read(self.inputs, start, stop, self.X[buf, :n])
+        self.y[buf, :n] = self.targets[start:stop]
+        if wrap and n < self.batchsize:
+            rest = self.batchsize - n
+            read(self.inputs, 0, rest, self.X[buf, n:])
+            self.y[buf, n:] = self.targets[0:rest]
+            n = self.batchsize
+        return n
+
+    def begin(self):
+        # The ring, and the mixer, are shared by every pass, so nothing of
+        # the last pass may still be writing to them.
+        if self.active is not None:
+            drain(self.active)
+        self.active = {}
+        return self.active
+
+    def batches(self, steps, wrap=False, augment=None, skip=0):
+        '''Yields the batches starting at each of steps, in order, leaving
+        out the first skip of them.'''
+        pending = self.begin()
+        tasks = [(lambda buf, start=start: self.fill(buf, start, wrap))
+                 for start in steps[skip:]]
+        return self.run(tasks, self.pool, pending, augment, skip)
+
+    def shuffled(self, size, block, rng, augment=None, skip=0):
+        '''Yields one pass of full batches over the set, mixed per sample
+        through a ShuffleBuffer of size images. With skip, the first skip
+        batches of the pass are drawn but not handed out.'''
+        pending = self.begin()
+        if self.mixer is None or self.mixer.size != min(size, len(self.inputs)):
+            self.mixer = ShuffleBuffer(self.inputs, self.targets, size)
+        mixer = self.mixer
+        mixer.reset(block, rng)
+        count = len(self.inputs) // self.batchsize
+        # Which images a batch gets depends on every draw before it, so a
+        # pass can only be resumed by replaying those draws.
+        for _ in range(min(skip, count)):
+            mixer.draw(self.X[0], self.y[0])
+        tasks = [(lambda buf: mixer.draw(self.X[buf], self.y[buf]))
+                 for _ in range(count - min(skip, count))]
+        # The buffer is filled in stream order, so only one batch can be
+        # drawn at a time.
+        if self.pool is not None and self.serial is None:
+            self.serial = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.run(tasks, self.serial, pending, augment, skip)
+
+    def check(self, pending):
+        if self.active is not pending:
+            raise RuntimeError('a later pass of the prefetcher has started')
+
+    def run(self, tasks, pool, pending, augment=None, skip=0):
+        nbuf = self.depth + 1
+        X = self.X
+        if augment is not None:
+            # Augmented batches go to a ring of their own, written by the
+            # same thread that read the batch, right after reading it.
+            shape = (nbuf, self.batchsize) + augment.shape(self.X.shape[2:])
+            if self.C is None or self.C.shape != shape:
+                self.C = aligned_empty(shape, self.X.dtype)
+            X = self.C
+            # Plan the whole pass, skipped batches included, so that a
+            # resumed pass gets the same crops as an uninterrupted one.
+            augment.plan(skip + len(tasks), self.batchsize, self.X.shape[2:])
+            tasks = [(lambda buf, seq=seq, task=task:
+                      augment(self.X[buf], self.C[buf], task(buf), seq))
+                     for seq, task in enumerate(tasks, skip)]
+        if pool is None:
+            for task in tasks:
+                self.check(pending)
+                n = task(0)
+                yield X[0, :n], self.y[0, :n]
+            return
+
+        def schedule(seq):
+            if seq < len(tasks):
+                pending[seq] = pool.submit(tasks[seq], seq % nbuf)
+        try:
+            for seq in range(self.depth):
+                schedule(seq)
+            for seq in range(len(tasks)):
+                self.check(pending)
+                # The buffer of the batch before this one is free again
+                # now that the consumer has asked for the next batch.
+                schedule(seq + self.depth)
+                n = pending.pop(seq).result()
+                buf = seq % nbuf
+                yield X[buf, :n], self.y[buf, :n]
+        finally:
+            # The consumer may stop early; don't let reads still in flight
+            # land in buffers that the next pass is about to use.
+            drain(pending)
+            if self.active is pending:
+                self.active = None
+
+class CropFlip(object):
+    '''Gives every image of a batch its own random crop and horizontal flip.
+
+    Each image is copied out of a strided view of its window, reversed
+    along x when flipped, straight into the batch handed to the consumer.
+    The offsets and flips of a whole pass are drawn up front from rng, so
+    they do not depend on the order in which the loader threads get to the
+    batches.
+    '''
+
+    def __init__(self, cropsz, rng):
+        self.cropsz = cropsz
+        self.rng = rng
+
+    def shape(self, imshape):
+        return tuple(imshape[:-2]) + (self.cropsz, self.cropsz)
+
+    def plan(self, count, batchsize, imshape):
+        # Offsets run over the same range as the per-batch crop in main.py.
+        room = (imshape[-2] - self.cropsz, imshape[-1] - self.cropsz)
+        self.offsets = numpy.stack([
+                self.rng.randint(0, max(r, 1), size=(count, batchsize))
+                for r in room], axis=-1)
+        self.flips = self.rng.randint(0, 2, size=(count, batchsize))
+
+    def __call__(self, src, dst, n, seq):
+        cs = self.cropsz
+        for i in range(n):
+            y, x = self.offsets[seq, i]
+            window = src[i, ..., y:y + cs, x:x + cs]
+            if self.flips[seq, i]:
+                window = window[..., ::-1]
+            dst[i] = window
+        return n
+
+class ShuffleBuffer(object):
+    '''Per-sample shuffling at close to sequential read speed.
+
+    The set is read as a stream of blocks of block consecutive images, with
+    the blocks in random order. The first size images of the stream fill a
+    pool in memory. Every batch is then drawn from random positions in the
+    pool, and the positions it frees are refilled with the next images of
+    the stream. Once the stream runs dry the pool shrinks until it is
+    empty, so that every image is drawn exactly once per pass.
+    '''
+
+    def __init__(self, inputs, targets, size):
+        self.inputs = inputs
+        self.targets = targets
+        self.size = min(size, len(inputs))
+        self.X = aligned_empty((self.size,) + tuple(inputs.shape[1:]), inputs.dtype)
+        self.y = numpy.empty((self.size,), dtype=targets.dtype)
+        self.stage = None
+
+    def reset(self, block, rng):
+        # Start a new pass; the pool is filled by the first draw, so that
+        # this happens in the background too.
+        self.rng = rng
+        starts = numpy.arange(0, len(self.inputs), block)
+        rng.shuffle(starts)
+        self.blocks = [(int(s), min(int(s) + block, len(self.inputs))) for s in starts]
+        self.blocks.reverse()
+        self.m = None
+
+    def stream(self, X, y):
+        # Copies the next images of the stream into X and y, and returns how
+        # many there were.
+        n = 0
+        while n < len(X) and self.blocks:
+            start, stop = self.blocks.pop()
+            k = min(stop - start, len(X) - n)
+            read(self.inputs, start, start + k, X[n:n + k])
+            y[n:n + k] = self.targets[start:start + k]
+            if start + k < stop:
+                self.blocks.append((start + k, stop))
+            n += k
+        return n
+
+    def draw(self, X, y):
+        if self.m is None:
+            self.m = self.stream(self.X, self.y)
+        n = min(len(X), self.m)
+        pick = self.rng.choice(self.m, n, replace=False)
+        X[:n] = self.X[pick]
+        y[:n] = self.y[pick]
+
+        if self.stage is None:
+            self.stage = aligned_empty(X.shape, X.dtype)
+            self.ystage = numpy.empty(y.shape, dtype=y.dtype)
+        k = self.stream(self.stage[:n], self.ystage[:n])
+        self.X[pick[:k]] = self.stage[:k]
+        self.y[pick[:k]] = self.ystage[:k]
+
+        # Close the holes the stream could not refill by moving the last
+        # images of the pool into them.
+        holes = pick[k:]
+        if len(holes):
+            m = self.m - len(holes)
+            low = numpy.sort(holes[holes < m])
+            tail = numpy.setdiff1d(numpy.arange(m, self.m), holes)
+            self.X[low] = self.X[tail]
+            self.y[low] = self.y[tail]
+            self.m = m
+        return n
@@ -3,15 +3,25 @@
 from progressbar import ProgressBar
 from pretty import *
 import argparse
+import checkpoint
+import compiled
+import confusion
+import dataset
 import experiment
+import loader
+import networks
+import occlusion
+import parallel
+import prediction
+import profiling
+import saliency
 import lasagne
 import theano
 import theano.tensor as T
-import pickle
 import numpy
 import time
-import re
 import random
+import telemetry
 import os
 import os.path
 
@@ -23,37 +33,89 @@ parser.add_argument('-s', '--batch-stop', type=int, help='stop after this many b
 parser.add_argument('-e', '--epoch-stop', type=int, help='stop after this many epochs', default=0)
 parser.add_argument('-o', '--outdir', help='store trained network state in this directory', default=None)
 parser.add_argument('-n', '--network', help='name of network experiment', default='base')
+parser.add_argument('--prefetch', type=int, help='number of batches to read ahead in the background', default=4)
+parser.add_argument('--loader-threads', type=int, help='number of threads reading batches ahead', default=2)
+parser.add_argument('--shuffle-buffer', type=int, help='shuffle training images one by one through an in-memory buffer of this many images (0 shuffles whole batches)', default=0)
+parser.add_argument('--shuffle-block', type=int, help='number of consecutive images read at a time to fill the shuffle buffer', default=1024)
+parser.add_argument('--sample-augment', help='give every training image its own random crop and flip, instead of one per batch', action='store_true')
+parser.set_defaults(sample_augment=False)
+parser.add_argument('--train-forward-pass', help='measure training accuracy with a separate deterministic pass instead of during training', action='store_true')
+parser.set_defaults(train_forward_pass=False)
+parser.add_argument('--async-validation', help='validate checkpoints in a separate worker process while training goes on', action='store_true')
+parser.set_defaults(async_validation=False)
+parser.add_argument('--keep-last', type=int, help='keep this many of the latest checkpoints (without any --keep option, all are kept)', default=0)
+parser.add_argument('--keep-best', help='keep the checkpoint with the best validation accuracy', action='store_true')
+parser.set_defaults(keep_best=False)
+parser.add_argument('--keep-every', type=int, help='keep the checkpoint of every this many epochs', default=0)
+parser.add_argument('--checkpoint-batches', type=int, help='also checkpoint within an epoch every this many batches', default=0)
+parser.add_argument('--checkpoint-seconds', type=float, help='also checkpoint within an epoch every this many seconds', default=0)
+parser.add_argument('--telemetry', help='append timing records as JSON lines to this file (default telemetry.jsonl in the output directory, "" for none)', default=None)
+parser.add_argument('--telemetry-interval', type=float, help='seconds of training batches summed into each timing record (0 for one per batch)', default=10)
+parser.add_argument('--progress-interval', type=float, help='least number of seconds between progress bar updates', default=0.5)
+parser.add_argument('-w', '--workers', type=int, help='train data-parallel in this many processes (set OMP_NUM_THREADS to share the cores among them)', default=1)
+parser.add_argument('--function-cache', help='directory to cache compiled functions in (default: periscope in the Theano compiledir)', default=None)
+parser.add_argument('--no-function-cache', help='compile functions afresh, without the cache', action='store_false', dest='function_cache_on')
+parser.set_defaults(function_cache_on=True)
+parser.add_argument('--profile', type=int, help='profile training and validation for this many batches each, write a per-layer report to the output directory, and exit', default=0)
 parser.add_argument('--limit', type=int, help='limit analyses to this many images', default=None)
 parser.add_argument('--no-plot', help='skip the plot', action='store_false')
 parser.set_defaults(plot=True)
 parser.add_argument('--confusion', help='compute confusion stats', action='store_true')
 parser.set_defaults(confusion=False)
 parser.add_argument('--response', help='compute response region', action='store_true')
+parser.add_argument('--response-grid', type=int, help='occlude each image on a grid of this many by this many patches', default=16)
+parser.add_argument('--response-patch', type=int, help='size in pixels of each occluded patch', default=23)
+parser.add_argument('--response-stride', type=int, help='offset in pixels between neighboring patches', default=7)
+parser.add_argument('--response-mode', help='occlude every patch, refine coarse blocks only where they matter, or pool gradient saliency onto the patches', choices=['dense', 'adaptive'] + saliency.MODES, default='dense')
+parser.add_argument('--response-coarse', type=int, help='in adaptive mode, start from blocks of this many by this many patches', default=4)
+parser.add_argument('--response-threshold', type=float, help='in adaptive mode, refine blocks that move a target probability by more than this', default=0.01)
+parser.add_argument('--smoothgrad-samples', type=int, help='in smoothgrad mode, average the gradient over this many noisy copies', default=8)
+parser.add_argument('--smoothgrad-noise', type=float, help='in smoothgrad mode, standard deviation of the noise as a fraction of the pixel range', default=0.15)
+parser.add_argument('--response-batch', type=int, help='number of probes per forward pass (default: the batch size)', default=None)
 parser.set_defaults(response=False)
 parser.add_argument('-v', '--verbose', action='count')
 args = parser.parse_args()
 
 if args.outdir is None:
     args.outdir = "exp-{}".format(args.network)
+if args.profile:
+    # profiles are taken of the functions of a single process
+    args.workers = 1
+if args.telemetry is None:
+    args.telemetry = os.path.join(args.outdir, 'telemetry.jsonl')
 
-imsz = 128
-cropsz = 117
+cropsz = networks.CROPSZ
 
 section("Setup")
 task("Loading data")
 subtask("Loading training set")
-y_train = numpy.memmap(os.path.join(args.tagged, "train.labels.db"), dtype=numpy.int32, mode='r')
-X_train = numpy.memmap(os.path.join(args.tagged, "train.images.db"), dtype=numpy.float32, mode='r', shape=(len(y_train), 3, imsz, imsz))
-cats = numpy.max(y_train)+1
+y_train = dataset.open_labels(args.tagged, "train")
+X_train = dataset.open_images(args.tagged, "train")
+imsz = X_train.shape[-1]
+cats = X_train.categories
 subtask("Loading validation set")
-y_val = numpy.memmap(os.path.join(args.tagged, "val.labels.db"), dtype=numpy.int32, mode='r')
-X_val = numpy.memmap(os.path.join(args.tagged, "val.images.db"), dtype=numpy.float32, mode='r', shape=(len(y_val), 3, imsz, imsz))
+y_val = dataset.open_labels(args.tagged, "val")
+X_val = dataset.open_images(args.tagged, "val")
+
+task("Building model")
+# Functions are compiled when first called, and kept in a cache on disk
+# between runs of the same setup.
+cachedir = None
+if args.function_cache_on and not args.profile:
+    cachedir = args.function_cache or compiled.default_dir()
+fnkey = (args.network, args.batchsize, cropsz, imsz, X_train.dtype.name,
+         args.momentum, args.workers > 1)
+profiles = {}
+def function(name, inputs, outputs, **kwargs):
+    if args.profile:
+        kwargs['profile'] = profiles[name] = profiling.stats()
+    return compiled.Function(name, fnkey, inputs, outputs, directory=cachedir,
+            sources=[__file__, experiment.__file__, networks.__file__], **kwargs)
 
-task("Building model and compiling functions")
 # create Theano variables for input and target minibatch
 learning_rates = numpy.logspace(-1.5, -4, 30, dtype=theano.config.floatX)
 learning_rate = T.scalar('l')
-input_var = T.tensor4('X')
+input_var = T.tensor4('X', dtype=X_train.dtype)
 target_var = T.ivector('y')
 
 # parameters
@@ -62,34 +124,29 @@ crop_var = T.ivector('c') # ycrop, xcrop
 center = numpy.zeros((2,), dtype=numpy.int32)
 center.fill(numpy.floor((imsz - cropsz)/2))
 
-# crop+flip
-cropped = input_var[:, :, crop_var[0]:crop_var[0]+cropsz, crop_var[1]:crop_var[1]+cropsz]
-prepared = cropped[:,:,:,::flip_var]
-
-# input layer is always the same
-network = lasagne.layers.InputLayer(
-        (args.batchsize, 3, cropsz, cropsz), prepared)
+# scale byte images into [0, 1], then crop+flip
+scaled, prepared = networks.prepare(input_var, cropsz, crop_var, flip_var)
 
 # import external network
-if args.network not in experiment.__dict__:
+if args.network not in networks.names():
     print("No network {} found.".format(args.network))
     import sys
     sys.exit(1)
 
-# dispatch to user-defined network
-network = experiment.__dict__[args.network](network, cropsz, args.batchsize)
+# dispatch to user-defined network, between the input layer and softmax
+# head that are always the same
+network = networks.build(args.network, prepared, cropsz, args.batchsize,
+        cats, sliced=args.workers > 1)
 
-# Last softmax layer is always the same
-from lasagne.nonlinearities import softmax
-network = lasagne.layers.DenseLayer(network, cats, nonlinearity=softmax)
+# let the profiles tell which layer every op came from
+if args.profile:
+    layer_names = profiling.tag_layers(network)
 
 # Output
-prediction = lasagne.layers.get_output(network)
+train_prediction = lasagne.layers.get_output(network)
 
 # create loss function
-from lasagne.regularization import regularize_network_params, l2, l1
-loss = lasagne.objectives.categorical_crossentropy(prediction, target_var).mean()
-loss += regularize_network_params(network, l2) * 1e-3
+loss = networks.loss(network, train_prediction, target_var)
 
 # create parameter update expressions
 params = lasagne.layers.get_all_params(network, trainable=True)
@@ -100,8 +157,26 @@ subtask("parameter count {} ({} trainable) in {} arrays".format(
         lasagne.layers.count_params(network, trainable=True),
         len(saveparams)))
 
+# top 1 and top 5 hit counts of the same training prediction
+train_1_hits = T.sum(lasagne.objectives.categorical_accuracy(train_prediction, target_var, top_k=1))
+train_5_hits = T.sum(lasagne.objectives.categorical_accuracy(train_prediction, target_var, top_k=5))
+
+if args.workers > 1:
+    # Every worker computes the gradient on its slice of the batch, and
+    # the update is then applied once, to their average.
+    grads = T.grad(loss, params)
+    grad_vars = [p.type() for p in params]
+    updates = lasagne.updates.nesterov_momentum(grad_vars, params, learning_rate=learning_rate, momentum=args.momentum)
+    grad_fn = function('grad', [flip_var, crop_var, input_var, target_var], [loss, train_1_hits, train_5_hits] + grads)
+    apply_fn = function('apply', [learning_rate] + grad_vars, [], updates=updates)
+
+# momentum state, kept in mid-epoch checkpoints
+trained = set(params)
+velocities = [v for v in updates.keys() if v not in trained]
+
 # compile training function that updates parameters and returns training loss
-train_fn = theano.function([learning_rate, flip_var, crop_var, input_var, target_var], loss, updates=updates)
+if args.workers == 1:
+    train_fn = function('train', [learning_rate, flip_var, crop_var, input_var, target_var], [loss, train_1_hits, train_5_hits], updates=updates)
 
 # Create a loss expression for validation/testing. The crucial difference here
 # is that we do a deterministic forward pass through the network, disabling
@@ -115,30 +190,54 @@ test_1_acc = T.mean(lasagne.objectives.categorical_accuracy(test_prediction, tar
 test_5_acc = T.mean(lasagne.objectives.categorical_accuracy(test_prediction, target_var, top_k=5))
 
 # compile a second function computing the validation loss and accuracy:
-val_fn = theano.function([input_var, target_var, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], [test_loss, test_1_acc, test_5_acc])
+val_fn = function('val', [input_var, target_var, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], [test_loss, test_1_acc, test_5_acc])
 
 # a function for debug output
-debug_fn = theano.function([input_var, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], test_prediction)
-
-def iterate_minibatches(inputs, targets, batchsize, shuffle=False, test=False):
+debug_fn = function('debug', [input_var, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], test_prediction)
+
+# the same, but for images already scaled into [0, 1] such as the probes
+probe_fn = debug_fn
+if args.response and X_train.dtype == numpy.uint8:
+    probe_var = T.tensor4('P')
+    probe_fn = function('probe', [probe_var, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], test_prediction, givens=[(scaled, probe_var)])
+
+# the gradient of the probability of a target category with respect to
+# images already scaled into [0, 1], for saliency
+if args.response and args.response_mode in saliency.MODES:
+    image_var = T.tensor4('S', dtype=theano.config.floatX)
+    saliency_target = T.ivector('t')
+    saliency_prediction = theano.clone(test_prediction, replace={scaled: image_var})
+    target_probability = saliency_prediction[T.arange(image_var.shape[0]), saliency_target]
+    saliency_fn = function('saliency', [image_var, saliency_target, theano.Param(flip_var, default=1), theano.Param(crop_var, default=center)], T.grad(target_probability.sum(), image_var))
+
+# Batches are read ahead on background threads, into buffers that are kept
+# for the whole run; one loader per data set and batch size.
+loaders = {}
+
+# A shuffled pass is fixed by its seed, so that it can be recreated to
+# resume at any batch.
+def iterate_minibatches(inputs, targets, batchsize, shuffle=False, test=False, augment=None, seed=None, skip=0):
     assert len(inputs) == len(targets)
+    key = (id(inputs), batchsize)
+    if key not in loaders:
+        loaders[key] = loader.Prefetcher(inputs, targets, batchsize,
+                depth=args.prefetch, threads=args.loader_threads)
     end = len(inputs)
+    if seed is None:
+        seed = random.randrange(2**32)
+    if shuffle and args.shuffle_buffer and end >= batchsize:
+        # Mix individual images, reading the set in large sequential blocks
+        rng = numpy.random.RandomState(seed)
+        return loaders[key].shuffled(args.shuffle_buffer, args.shuffle_block, rng, augment, skip)
     if shuffle:
-        start = random.randrange(end)
+        order = random.Random(seed)
+        start = order.randrange(end)
         steps = [n % end for n in range(start, end + start, batchsize)]
-        random.shuffle(steps)
+        order.shuffle(steps)
     else:
         steps = range(0, end, batchsize)
-    for start_idx in steps:
-        if shuffle and start_idx + batchsize > end:
-            # Handle wraparound case
-            e1 = slice(start_idx, end)
-            e2 = slice(0, (start_idx + batchsize) % end)
-            yield (numpy.concatenate([inputs[e1], inputs[e2]]),
-                   numpy.concatenate([targets[e1], targets[e2]]))
-        else:
-            excerpt = slice(start_idx, start_idx + batchsize)
-            yield inputs[excerpt], targets[excerpt]
+    # Handle wraparound case by continuing from the start of the set
+    return loaders[key].batches(steps, wrap=shuffle, augment=augment, skip=skip)
 
 training = []
 validation = []
@@ -146,12 +245,12 @@ end = len(learning_rates)
 if args.epoch_stop != 0 and args.epoch_stop < end:
     end = args.epoch_stop
 
-if args.plot:
-    import matplotlib
-    matplotlib.use('Agg') # avoid the need for X
+# Plots are drawn by replot.py in the background. A plot asked for while
+# the previous one is still being drawn is skipped, unless wait is set.
+plotter = None
 
-def replot():
-    global args
+def replot(wait=False):
+    global args, plotter, monitor
     if not args.plot:
         return
 
@@ -160,81 +259,47 @@ def replot():
     if len(validation) == 0:
         return
 
-    import seaborn as sns
-    import matplotlib.pyplot as plt
-    sns.set(style="ticks", color_codes=True)
-
-    fig = plt.figure()
-    ax_loss = fig.add_subplot(1, 2, 1)
-    ax_err = fig.add_subplot(1, 2, 2)
+    if plotter is not None and plotter.poll() is None:
+        if not wait:
+            return
+        plotter.wait()
 
-    # styles
-    ax_loss.grid(True)
-    ax_err.grid(b=True, which='major', color='b', linestyle='-', alpha=0.2)
-    ax_err.grid(b=True, which='minor', color='b', linestyle='-', alpha=0.1)
-    ax_err.minorticks_on()
-    ax_err.grid(True)
-    #ax_loss.set_yscale('log')
-    #ax_err.set_yscale('log')
-
-    # limits
     global end
-    ax_loss.set_xlim(0, end)
-    ax_err.set_xlim(0, end)
-    ax_err.set_ylim(0, 1)
-    #ax_err.set_ylim(1e-5, 1)
-
-    # plot loss
-    xend = len(training)+1
-    ax_loss.plot(range(1, xend), [dp[0] for dp in training], 'b', marker='o', markersize=4)
-    xend = len(validation)+1
-    ax_loss.plot(range(1, xend), [dp[0] for dp in validation], 'r--', marker='o', markersize=4)
-    ax_loss.legend(['Training loss', 'Validation loss'])
-    ax_loss.set_title('Model loss')
-
-    # plot error
-    xend = len(training)+1
-    ax_err.plot(range(1, xend), [1-dp[1] for dp in training], 'b', marker='o', markersize=4)
-    ax_err.plot(range(1, xend), [1-dp[2] for dp in training], 'r', marker='o', markersize=4)
-    xend = len(validation)+1
-    ax_err.plot(range(1, xend), [1-dp[1] for dp in validation], 'y--', marker='s', markersize=4)
-    ax_err.plot(range(1, xend), [1-dp[2] for dp in validation], 'm--', marker='s', markersize=4)
-    ax_err.legend(['Training exact', 'Training top 5', 'Validation exact', 'Validation top 5'])
-    ax_err.set_title('Match error')
-
-    import tempfile
-    with tempfile.NamedTemporaryFile(delete=False, dir=args.outdir) as fp:
-        fig.savefig(fp, format='png', dpi=192)
-        plt.close(fig)
-        fp.close()
-        os.rename(fp.name, os.path.join(args.outdir, 'plot.png'))
+    import json
+    import subprocess
+    import sys
+    with telemetry.Timer(monitor, 'plot'):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replot.py')
+        plotter = subprocess.Popen([sys.executable, script,
+                os.path.join(args.outdir, 'plot.png'), '-e', str(end)],
+                stdin=subprocess.PIPE)
+        plotter.stdin.write(json.dumps({
+            'training': [[float(v) for v in dp] for dp in training],
+            'validation': [[float(v) for v in dp] for dp in validation],
+        }).encode('utf-8'))
+        plotter.stdin.close()
+        if wait:
+            plotter.wait()
 
 
 def latest_cachefile():
     global args
-    caches = [n for n in os.listdir(args.outdir) if re.match(r'^epoch-\d+\.mdl$', n)]
+    caches = checkpoint.epochs(args.outdir)
     if len(caches) == 0:
         return None
-    caches.sort(key=lambda x: -int(re.match(r'^epoch-(\d+)\.mdl$', x).group(1)))
-    return os.path.join(args.outdir, caches[0])
+    return caches[max(caches)]
 
 def reload_model(resumefile):
     global epoch, training, validation, saveparams, params
-    lfile = open(resumefile, 'rb')
     section("Restoring state from {}".format(resumefile))
-    lfile.seek(0)
-    task("Loading format version")
-    formatver = pickle.load(lfile)
-    if type(formatver) != int:
-        formatver = 0
-        lfile.seek(0)
+    task("Loading checkpoint")
+    stored = checkpoint.load(resumefile)
+    formatver = stored['format']
     subtask("using format {}".format(formatver))
-    task("Loading parameters")
-    state = pickle.load(lfile)
-    task("Loading epoch information")
-    epoch = pickle.load(lfile)
-    training = pickle.load(lfile)
-    validation = pickle.load(lfile)
+    state = stored['params']
+    epoch = stored['epoch']
+    training = stored['training']
+    validation = stored['validation']
     task("Restoring parameter values")
     fileparams = saveparams if formatver >= 1 else params
     assert len(fileparams) == len(state)
@@ -243,22 +308,120 @@ def reload_model(resumefile):
     epoch += 1
     subtask("Resuming at epoch {}".format(epoch))
 
+# Checkpoints are written in the background while the next epoch trains;
+# get_value() hands the writer copies that training will not touch.
+writer = checkpoint.Writer()
+
 def save_model(sfilename):
-    global epoch, training, validation, saveparams
+    global epoch, training, validation, saveparams, args
     subtask("Storing trained parameters as {}".format(sfilename))
-    with open(sfilename, 'wb+') as sfile:
-        sfile.seek(0)
-        sfile.truncate()
-        formatver = 1
-        pickle.dump(formatver, sfile)
-        pickle.dump([p.get_value() for p in saveparams], sfile)
-        pickle.dump(epoch, sfile)
-        pickle.dump(training, sfile)
-        pickle.dump(validation, sfile)
+    history = list(validation)
+    def after():
+        checkpoint.prune(args.outdir, history, last=args.keep_last,
+                best=args.keep_best, every=args.keep_every)
+        # the epoch is done, so a checkpoint from within it is obsolete
+        if os.path.exists(partialfile):
+            os.remove(partialfile)
+    submitted = time.time()
+    def written():
+        after()
+        monitor.event('checkpoint_written', file=sfilename,
+                seconds=round(time.time() - submitted, 3))
+    with telemetry.Timer(monitor, 'checkpoint', file=sfilename):
+        writer.save(sfilename, [p.get_value() for p in saveparams],
+                epoch, training, validation, after=written)
+
+# A mid-epoch checkpoint also holds the momentum, where the pass had got
+# to, and everything random needed to carry on as if never interrupted.
+partialfile = os.path.join(args.outdir, 'partial.mdl')
+
+def save_partial(position):
+    global epoch, training, validation, saveparams, velocities
+    state = numpy.random.get_state()
+    extra = dict(position)
+    extra.update({
+        'epoch': epoch,
+        'momentum': len(velocities),
+        'random': random.getstate(),
+        'numpy': [state[0], state[1].tolist()] + list(state[2:]),
+    })
+    with telemetry.Timer(monitor, 'checkpoint', file=partialfile, batch=position['batch']):
+        writer.save(partialfile, [p.get_value() for p in saveparams + velocities],
+                epoch - 1, training, validation, extra=extra)
+
+def reload_partial():
+    global epoch, training, validation, saveparams, velocities
+    try:
+        stored = checkpoint.load(partialfile)
+    except FileNotFoundError:
+        return None
+    position = stored['extra']
+    if position['epoch'] != epoch or position['momentum'] != len(velocities):
+        return None
+    task("Restoring mid-epoch state from {}".format(partialfile))
+    for p, v in zip(saveparams + velocities, stored['params']):
+        p.set_value(v)
+    training = stored['training']
+    validation = stored['validation']
+    s = position['random']
+    random.setstate((s[0], tuple(s[1]), s[2]))
+    s = position['numpy']
+    numpy.random.set_state((s[0], numpy.array(s[1], dtype=numpy.uint32)) + tuple(s[2:]))
+    subtask("Resuming at batch {} of epoch {}".format(position['batch'] + 1, epoch))
+    return position
+
+# With --async-validation, validate.py evaluates each checkpoint as it
+# appears and appends its results to validation.txt.
+
+# Stands in for an epoch the worker has no result for, because it was
+# stopped or could not read the checkpoint; plotted as a gap.
+MISSING = (float('nan'),) * 3
+
+def missing(result):
+    return numpy.isnan(result[1])
+
+def collect_validation(final=False):
+    global validation, training
+    results = checkpoint.read_results(args.outdir)
+    # a worker started since may have validated an epoch missed before
+    for e, result in enumerate(validation):
+        if missing(result) and e in results:
+            validation[e] = results[e]
+    # The worker goes through the epochs in order, so one without a result
+    # before one with a result will not get one; once it has exited,
+    # neither will any other.
+    upto = len(training) if final else min(len(training), max(results, default=-1) + 1)
+    gaps = []
+    while len(validation) < upto:
+        if len(validation) not in results:
+            gaps.append(len(validation))
+        validation.append(results.get(len(validation), MISSING))
+    if gaps:
+        subtask("No validation results for epochs {}".format(
+            ', '.join(str(e) for e in gaps)))
+
+def start_validation_worker():
+    global args, validation, end
+    import subprocess
+    import sys
+    # Don't have the worker redo epochs validated before it started.
+    results = checkpoint.read_results(args.outdir)
+    checkpoint.append_results(args.outdir, [(e, result)
+            for e, result in enumerate(validation)
+            if e not in results and not missing(result)])
+    log = open(os.path.join(args.outdir, 'validate.log'), 'a')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validate.py')
+    return subprocess.Popen([sys.executable, script,
+            '-t', args.tagged, '-n', args.network, '-o', args.outdir,
+            '-b', str(args.batchsize), '-u', str(end),
+            '-p', str(os.getpid()), '--prefetch', str(args.prefetch)] +
+            ([] if args.function_cache_on else ['--no-function-cache']),
+            stdout=log, stderr=subprocess.STDOUT)
 
 epoch = 0
 sfilename = None
 os.makedirs(args.outdir, exist_ok=True)
+monitor = telemetry.Telemetry(args.telemetry, args.telemetry_interval)
 try:
     resumefile = latest_cachefile()
     if resumefile is None:
@@ -267,11 +430,67 @@ try:
     sfilename = resumefile
 except EOFError:
     task("No model state stored; starting afresh")
+resumed = reload_partial()
+
+# pick up what a validation worker finished after the checkpoint was saved
+collect_validation()
+
+worker = None
+if args.async_validation:
+    task("Starting validation worker (log in {})".format(
+        os.path.join(args.outdir, 'validate.log')))
+    worker = start_validation_worker()
+
+if args.profile:
+    section("Profiling")
+    os.makedirs(args.outdir, exist_ok=True)
+    for name, X, Y, run in [
+            ('train', X_train, y_train, lambda inp, res: train_fn(
+                learning_rates[min(epoch, len(learning_rates) - 1)], 1, center, inp, res)),
+            ('val', X_val, y_val, lambda inp, res: val_fn(inp, res))]:
+        task("Profiling {} for {} batches".format(name, args.profile))
+        i = 0
+        p = progress(args.profile)
+        for inp, res in iterate_minibatches(X, Y, args.batchsize, shuffle=False):
+            if i == args.profile:
+                break
+            run(inp, res)
+            i += 1
+            p.update(i)
+        fname = os.path.join(args.outdir, 'profile-{}'.format(name))
+        rows = profiling.report(profiles[name], layer_names, i)
+        profiling.write(rows, fname, "{} {} on {} batches of {}".format(
+                args.network, name, i, args.batchsize))
+        for r in rows[:5]:
+            subtask("{:5.1f}% {}".format(r['share'] * 100, r['layer']))
+        subtask("Report in {}.txt".format(fname))
+    import sys
+    sys.exit(0)
+
+trainer = None
+if args.workers > 1:
+    task("Starting {} data-parallel training workers".format(args.workers - 1))
+    def reseed(w):
+        # dropout masks of their own, without touching the global RNGs
+        entropy = numpy.random.RandomState()
+        for layer in lasagne.layers.get_all_layers(network):
+            if hasattr(layer, '_srng'):
+                layer._srng.seed(entropy.randint(1, 2**30))
+    imshape = (3, cropsz, cropsz) if args.sample_augment else (3, imsz, imsz)
+    # compiled before forking, so the workers don't each compile their own
+    grad_fn.compile()
+    apply_fn.compile()
+    trainer = parallel.DataParallel(args.workers, grad_fn, apply_fn,
+            params, [p for p in saveparams if p not in trained],
+            args.batchsize, imshape, X_train.dtype, reseed)
+    train_fn = trainer.step
 
 section("Training")
 
 # Finally, launch the training loop.
 while epoch < end:
+    if worker is not None:
+        collect_validation()
     replot()
 
     task("Starting training epoch {}".format(epoch))
@@ -279,6 +498,9 @@ while epoch < end:
 
     # How much work will we have to do?
     train_batches = len(range(0, len(X_train), args.batchsize))
+    if args.shuffle_buffer and len(X_train) >= args.batchsize:
+        # a pass through the shuffle buffer only yields full batches
+        train_batches = len(X_train) // args.batchsize
     val_batches = len(range(0, len(X_val), args.batchsize))
     train_test_batches = val_batches
 
@@ -286,83 +508,190 @@ while epoch < end:
         train_batches = min(train_batches, args.batch_stop)
 
     # In each epoch, we do a pass over minibatches of the training data:
-    train_loss = 0
-    p = progress(train_batches)
-    i = 1
+    if resumed is not None:
+        position = resumed
+        resumed = None
+    else:
+        position = {
+            'batch': 0,
+            'seed': random.randrange(2**32),
+            'augment_seed': random.randrange(2**32),
+            'train_loss': 0,
+            'hits1': 0,
+            'hits5': 0,
+            'seen': 0,
+        }
+    train_loss = position['train_loss']
+    train_hits1 = position['hits1']
+    train_hits5 = position['hits5']
+    train_seen = position['seen']
+    lr = learning_rates[epoch]
+    monitor.event('epoch_start', epoch=epoch, learning_rate=lr,
+            batch=position['batch'], batches=train_batches)
+    monitor.reset()
+    p = progress(train_batches, interval=args.progress_interval)
+    i = position['batch'] + 1
     frame = numpy.zeros((2,), dtype=numpy.int32)
-    for inp, res in iterate_minibatches(X_train, y_train, args.batchsize, shuffle=True):
-        flip = numpy.random.randint(0, 2) and 1 or -1
-        frame[0] = numpy.random.randint(0, imsz - cropsz)
-        frame[1] = numpy.random.randint(0, imsz - cropsz)
-        train_loss += train_fn(learning_rates[epoch], flip, frame, inp, res)
+    augment = None
+    if args.sample_augment:
+        # The loader threads hand over batches already cropped and flipped
+        # image by image, which the graph then takes whole, unflipped.
+        augment = loader.CropFlip(cropsz,
+                numpy.random.RandomState(position['augment_seed']))
+    flip = 1
+    last_save = time.time()
+    batches = iterate_minibatches(X_train, y_train, args.batchsize,
+            shuffle=True, augment=augment, seed=position['seed'],
+            skip=position['batch'])
+    # time between batches is counted as waiting on the loader
+    ready = time.time()
+    for inp, res in batches:
+        if augment is None:
+            flip = numpy.random.randint(0, 2) and 1 or -1
+            frame[0] = numpy.random.randint(0, imsz - cropsz)
+            frame[1] = numpy.random.randint(0, imsz - cropsz)
+        fed = time.time()
+        loss, hits1, hits5 = train_fn(lr, flip, frame, inp, res)
+        monitor.batch(len(res), fed - ready, time.time() - fed,
+                epoch=epoch, learning_rate=lr)
+        train_loss += loss
+        train_hits1 += hits1
+        train_hits5 += hits5
+        train_seen += len(res)
         p.update(i)
+        if i < train_batches and (
+                (args.checkpoint_batches and i % args.checkpoint_batches == 0) or
+                (args.checkpoint_seconds and time.time() - last_save >= args.checkpoint_seconds)):
+            position.update({'batch': i, 'train_loss': float(train_loss),
+                    'hits1': float(train_hits1), 'hits5': float(train_hits5),
+                    'seen': train_seen})
+            save_partial(position)
+            last_save = time.time()
         i = i+1
         if i > train_batches:
             break
-
-    # Only do forward pass on a subset of the training data
-    subtask("Doing forward pass on training data (size: {})".format(len(X_val)))
-    p = progress(train_test_batches)
-    i = 0
-    train_acc1 = 0
-    train_acc5 = 0
-    for inp, res in iterate_minibatches(X_train, y_train, args.batchsize, shuffle=True):
-        i = i+1
-        _, acc1, acc5 = val_fn(inp, res)
-        p.update(i)
-        train_acc1 += acc1
-        train_acc5 += acc5
-        if i == train_test_batches:
-            break
-
-    subtask("Doing forward pass on validation data (size: {})".format(len(X_val)))
-    # Also do a validation data forward pass
-    val_loss = 0
-    val_acc1 = 0
-    val_acc5 = 0
-    p = progress(val_batches)
-    i = 0
-    for inp, res in iterate_minibatches(X_val, y_val, args.batchsize, shuffle=False):
-        loss, acc1, acc5 = val_fn(inp, res)
-        val_loss += loss
-        val_acc1 += acc1
-        val_acc5 += acc5
-        i += 1
-        p.update(i)
+        ready = time.time()
+    # stop the reads still in flight before the loader is used again
+    batches.close()
+    monitor.flush(epoch=epoch, learning_rate=lr)
+
+    # Training accuracy comes from the predictions made while training,
+    # with dropout on, unless asked for a deterministic pass.
+    train_acc1 = train_hits1 / max(train_seen, 1)
+    train_acc5 = train_hits5 / max(train_seen, 1)
+    if args.train_forward_pass:
+        started = time.time()
+        # Only do forward pass on a subset of the training data
+        subtask("Doing forward pass on training data (size: {})".format(len(X_val)))
+        p = progress(train_test_batches, interval=args.progress_interval)
+        i = 0
+        train_acc1 = 0
+        train_acc5 = 0
+        for inp, res in iterate_minibatches(X_train, y_train, args.batchsize, shuffle=True):
+            i = i+1
+            _, acc1, acc5 = val_fn(inp, res)
+            p.update(i)
+            train_acc1 += acc1
+            train_acc5 += acc5
+            if i == train_test_batches:
+                break
+        train_acc1 /= i
+        train_acc5 /= i
+        monitor.event('train_forward_pass', epoch=epoch,
+                seconds=round(time.time() - started, 3))
+
+    if worker is None:
+        started = time.time()
+        subtask("Doing forward pass on validation data (size: {})".format(len(X_val)))
+        # Also do a validation data forward pass
+        val_loss = 0
+        val_acc1 = 0
+        val_acc5 = 0
+        p = progress(val_batches, interval=args.progress_interval)
+        i = 0
+        for inp, res in iterate_minibatches(X_val, y_val, args.batchsize, shuffle=False):
+            loss, acc1, acc5 = val_fn(inp, res)
+            val_loss += loss
+            val_acc1 += acc1
+            val_acc5 += acc5
+            i += 1
+            p.update(i)
+        monitor.event('validation', epoch=epoch,
+                seconds=round(time.time() - started, 3))
 
     # record performance
-    training.append((train_loss/train_batches, train_acc1/train_test_batches, train_acc5/train_test_batches))
-    validation.append((val_loss/val_batches, val_acc1/val_batches, val_acc5/val_batches))
+    training.append((train_loss/train_batches, train_acc1, train_acc5))
+    if worker is None:
+        validation.append((val_loss/val_batches, val_acc1/val_batches, val_acc5/val_batches))
+    else:
+        collect_validation()
 
     # Save the model and advance to the next epoch.
     # using the training set.
     sfilename = os.path.join(args.outdir, 'epoch-%03d.mdl' % epoch)
     save_model(sfilename)
+    monitor.event('epoch', epoch=epoch, learning_rate=lr,
+            seconds=round(time.time() - start_time, 3),
+            training=[float(v) for v in training[-1]],
+            validation=[float(v) for v in validation[epoch]]
+                    if len(validation) > epoch else None)
     epoch += 1
 
     # Then we print the results for this epoch:
-    subtask(("Epoch results:" +
-        " {:.2f}%/{:.2f}% (t1acc, v1acc)" +
-        " {:.2f}%/{:.2f}% (t5acc, v5acc)").format(
-        training[-1][1] * 100,
-        validation[-1][1] * 100,
-        training[-1][2] * 100,
-        validation[-1][2] * 100,
-    ))
-
-
-replot()
-
-def make_confusion_db(name, fname, X, Y):
+    if len(validation) == len(training):
+        subtask(("Epoch results:" +
+            " {:.2f}%/{:.2f}% (t1acc, v1acc)" +
+            " {:.2f}%/{:.2f}% (t5acc, v5acc)").format(
+            training[-1][1] * 100,
+            validation[-1][1] * 100,
+            training[-1][2] * 100,
+            validation[-1][2] * 100,
+        ))
+    else:
+        subtask(("Epoch results:" +
+            " {:.2f}% (t1acc) {:.2f}% (t5acc), validation pending").format(
+            training[-1][1] * 100,
+            training[-1][2] * 100,
+        ))
+
+writer.wait()
+if trainer is not None:
+    trainer.close()
+
+if worker is not None:
+    task("Waiting for validation worker")
+    worker.wait()
+    collect_validation(final=True)
+    # epochs validated after their last checkpoint was saved
+    checkpoint.prune(args.outdir, validation, last=args.keep_last,
+            best=args.keep_best, every=args.keep_every)
+
+replot(wait=True)
+
+# Predictions are looked up in the store by what they are computed from,
+# and only computed when they are not there; fname is linked to them.
+def predict(fname, X, Y):
     global args
-    cfile = open(os.path.join(args.outdir, fname), 'wb+')
     cases = len(X) if not args.limit else min(args.limit, len(X))
-    pred_out = numpy.memmap(
-        cfile, dtype=numpy.float32, shape=(cases, cats), mode='w+')
+    subset = fname.split('.')[0]
+    key = prediction.key([p.get_value(borrow=True) for p in saveparams],
+            args.tagged, subset, {'network': args.network, 'cropsz': cropsz,
+            'crop': center.tolist(), 'cases': cases})
+    pred_out = prediction.lookup(args.outdir, key, (cases, cats))
+    if pred_out is not None:
+        subtask("Reusing predictions {}".format(key['digest']))
+    else:
+        pred_out = prediction.create(args.outdir, key, (cases, cats))
+        compute_predictions(pred_out, X, Y, cases)
+        pred_out = prediction.commit(args.outdir, key, pred_out,
+                epoch=epoch)
+    prediction.publish(args.outdir, key, fname)
+    return pred_out
+
+def compute_predictions(pred_out, X, Y, cases):
     test_batches = len(range(0, cases, args.batchsize))
     p = progress(test_batches)
     i = 0
-    accn = {}
     for inp, res in iterate_minibatches(X, Y, args.batchsize, shuffle=False):
         s = i * args.batchsize
         if s + args.batchsize > pred_out.shape[0]:
@@ -370,21 +699,21 @@ def make_confusion_db(name, fname, X, Y):
         pred_out[s:s+args.batchsize, :] = debug_fn(inp)
         i += 1
         p.update(i)
-        topindex = numpy.argsort(-pred_out[s:s+args.batchsize], axis=1)
-        for index in range(topindex.shape[0]):
-            confusion = numpy.where(topindex[index] == res[index])[0][0]
-            accn[confusion] = accn.get(confusion, 0) + 1
         if i >= test_batches:
             break
-    correct = 0
-    for index in range(10):
-        correct += accn.get(index, 0)
+
+def make_confusion_db(name, fname, X, Y):
+    pred_out = predict(fname, X, Y)
+    for index, acc in enumerate(confusion.accuracy(
+            confusion.ranks(pred_out, Y), 10)):
         subtask("{} acc@{}: {:.2f}%".format(
                 name,
                 index + 1,
-                100.0 * correct / cases))
-    del pred_out
-    cfile.close()
+                100.0 * acc))
+    for true, picked, count in confusion.most_confused(
+            confusion.matrix(pred_out, Y), 5):
+        subtask("{} confused {} for {}: {} images".format(
+                name, true, picked, count))
 
 if args.confusion:
     section("Debugging")
@@ -393,60 +722,51 @@ if args.confusion:
     task("Evaluating confusion matrix on training data set")
     make_confusion_db('Training set', 'train.confusion.db', X_train, y_train)
 
-# Divides the image into 16x16 overlapping squares of 23x23 pixels, each
-# offset 7 pixels from the previous
-res = 16
-pix = 23
-st = 7
-noise = numpy.random.RandomState(123).normal(size=[pix-4, pix-4])
-def make_response_probe(image):
-    result = numpy.tile(image, (res*res, 1, 1, 1))
-    for x in range(res):
-        for y in range(res):
-            for c in range(3):
-                avg = numpy.average(
-                        result[x + y * res, c,
-                               y*st:y*st+pix, x*st:x*st+pix])
-                anti = (avg + 0.5) * numpy.ones([pix, pix])
-                box = anti
-                box[2:pix-2,2:pix-2] += noise + 10
-                box = box % 1
-                result[x + y * res, c,
-                       y*st:y*st+pix, x*st:x*st+pix] = box
-    return result
-
-def make_response_file(name, fname, cname, X, Y, use_first=False):
+# Occludes each image with a grid of overlapping square patches, by default
+# 16x16 patches of 23x23 pixels, each offset 7 pixels from the previous,
+# and records how the score of the true category and of the top predicted
+# category respond, both from the same forward passes. In adaptive mode,
+# only the blocks of patches that matter are occluded patch by patch; the
+# saliency modes take gradients instead, and pool them onto the patches.
+def make_response_files(name, subset, X, Y):
     global args
     task("Evaluating response regions on %s" % name)
-    assert args.batchsize == 256
     cases = len(X) if not args.limit else min(args.limit, len(X))
-    if use_first:
-        cfile = open(os.path.join(args.outdir, cname), 'r')
-        pred = numpy.memmap(cfile, dtype=numpy.float32, mode='r')
-        pred.shape = (pred.shape[0] / cats, cats)
-        topindex = numpy.argsort(-pred, axis=1)
-    rfile = open(os.path.join(args.outdir, fname), 'wb+')
-    resp_out = numpy.memmap(rfile, dtype=numpy.float32,
-            shape=(cases, 256), mode='w+')
-    p = progress(cases)
-    for index in range(cases):
-        probe = make_response_probe(X[index])
-        if use_first:
-            toview = topindex[index][0]
-        else:
-            toview = Y[index]
-        resp_out[index] = debug_fn(probe)[:,toview]
-        p.update(index + 1)
-    del resp_out
-    rfile.close()
+    topindex, _ = confusion.top(predict(subset + '.confusion.db', X, Y), 1)
+    columns = numpy.stack([Y[:cases], topindex[:cases, 0]], axis=1)
+    geometry = [probe_fn, (3, imsz, imsz), args.response_batch or args.batchsize,
+            args.response_grid, args.response_patch, args.response_stride]
+    if args.response_mode == 'adaptive':
+        engine = occlusion.Adaptive(*geometry, coarse=args.response_coarse,
+                threshold=args.response_threshold)
+    elif args.response_mode in saliency.MODES:
+        geometry[0] = saliency_fn
+        engine = saliency.Saliency(*geometry, mode=args.response_mode,
+                samples=args.smoothgrad_samples, noise=args.smoothgrad_noise)
+    else:
+        engine = occlusion.Engine(*geometry)
+    k = args.response_grid ** 2
+    targets = [('response', 'true'), ('topresponse', 'top')]
+    files = [open(os.path.join(args.outdir, '{}.{}.db'.format(subset, kind)),
+            'wb+') for kind, _ in targets]
+    outs = [numpy.memmap(rfile, dtype=numpy.float32, shape=(cases, k),
+            mode='w+') for rfile in files]
+    engine.run(X, columns, outs,
+            scale=255 if X.dtype == numpy.uint8 else None,
+            progress=progress(cases))
+    if args.response_mode == 'adaptive':
+        subtask("{:.1f} occlusion probes per image, against {} for dense".format(
+                engine.passes / max(cases, 1), k))
+    elif args.response_mode != 'dense':
+        subtask("{:.1f} passes per image, against {} for dense".format(
+                engine.passes / max(cases, 1), k))
+    del outs
+    for rfile, (kind, target) in zip(files, targets):
+        rfile.close()
+        occlusion.write_geometry(rfile.name,
+                dict(engine.geometry(), target=target))
 
 if args.response:
     section("Visualization")
-    make_response_file('validation set',
-        'val.response.db', 'val.confusion.db', X_val, y_val)
-    make_response_file('training set',
-        'train.response.db', 'train.confusion.db', X_train, y_train)
-    make_response_file('validation set',
-        'val.topresponse.db', 'val.confusion.db', X_val, y_val, True)
-    make_response_file('training set',
-        'train.topresponse.db', 'train.confusion.db', X_train, y_train, True)
+    make_response_files('validation set', 'val', X_val, y_val)
+    make_response_files('training set', 'train', X_train, y_train)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import checkpoint
 import numpy
 import sys
 import re
@@ -26,26 +27,11 @@ i = -1
 for model in args.model:
     i += 1
     try:
-        import pickle
-        model.seek(0)
-        formatver = pickle.load(model)
-        if type(formatver) != int:
-            formatver = 0
-            model.seek(0)
-
-        # add imports for unpickle to work
-        import lasagne
-        import theano
-        pickle.load(model)  # state
+        stored = checkpoint.load(model, params=False)
 
         # the things we actually care about
-        epoch = pickle.load(model)
-        if args.set == "training":
-            vals = pickle.load(model)
-            pickle.load(model) # validation
-        else:
-            pickle.load(model) # training
-            vals = pickle.load(model)
+        epoch = stored['epoch']
+        vals = stored[args.set]
 
         if args.atk == 1:
             val = numpy.max([v[1] for v in vals])
@@ -54,6 +40,6 @@ for model in args.model:
 
         num = re.sub(r'^.*?(\d+(\.\d+)?).*$', r'\1', args.names[i])
         print("{}\t{}\t{}\t{}".format(args.names[i], epoch, val, num))
-    except EOFError:
+    except (EOFError, ValueError):
         print("Model {} is invalid".format(model.name))
         sys.exit(1)
@@ -0,0 +1,47 @@
+import experiment
+import inspect
+import lasagne
+import theano
+import theano.tensor as T
+
+# The parts of the graph that are the same for every network in
+# experiment.py: scaling and cropping the input, the input layer, the
+# softmax head, and the regularized training loss. Everything that builds
+# a network, for training or just to measure it, goes through here, so
+# that they all build the same one.
+
+CROPSZ = 117
+
+def names():
+    '''Every function in experiment.py that builds a network body.'''
+    found = []
+    for name, f in inspect.getmembers(experiment, inspect.isfunction):
+        if f.__module__ == experiment.__name__ and \
+                list(inspect.signature(f).parameters) == ['network', 'cropsz', 'batchsz']:
+            found.append(name)
+    return found
+
+def prepare(input_var, cropsz, crop_var, flip_var):
+    '''Scales byte images into [0, 1], then crops and flips them. Returns
+    the scaled and the prepared images.'''
+    scaled = input_var
+    if input_var.dtype == 'uint8':
+        scaled = T.cast(input_var, theano.config.floatX) / 255
+    cropped = scaled[:, :, crop_var[0]:crop_var[0]+cropsz, crop_var[1]:crop_var[1]+cropsz]
+    return scaled, cropped[:, :, :, ::flip_var]
+
+def build(name, prepared, cropsz, batchsize, categories, sliced=False):
+    '''The network name of experiment.py on prepared images, with the
+    softmax head. With sliced, the input layer takes batches of any size,
+    as data-parallel workers each see only a slice of the batch.'''
+    network = lasagne.layers.InputLayer(
+            (None if sliced else batchsize, 3, cropsz, cropsz), prepared)
+    network = experiment.__dict__[name](network, cropsz, batchsize)
+    from lasagne.nonlinearities import softmax
+    return lasagne.layers.DenseLayer(network, categories, nonlinearity=softmax)
+
+def loss(network, prediction, target_var):
+    '''The training loss: cross-entropy, plus L2 regularization.'''
+    from lasagne.regularization import regularize_network_params, l2
+    loss = lasagne.objectives.categorical_crossentropy(prediction, target_var).mean()
+    return loss + regularize_network_params(network, l2) * 1e-3
@@ -0,0 +1,338 @@
+import json
+import numpy
+import os.path
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Occlusion probes: copies of an image, each with one of res x res
+# overlapping square patches painted over. Patch (x, y) covers pix x pix
+# pixels, offset st pixels from its neighbors, and is filled with the
+# patch's own mean shifted by half, with noise added inside a two pixel
+# border, all wrapped into [0, 1). Probe x + y * res covers patch (x, y).
+#
+# The probes of many images are built at once, into buffers that are kept
+# from one call to the next. An Engine streams the probes of a whole image
+# set through the network in batches of any size, and takes the response
+# of every target category it is asked for from the same forward pass. The
+# geometry is written next to every response file, as JSON.
+
+def geometry_name(fname):
+    return os.path.splitext(fname)[0] + '.json'
+
+def write_geometry(fname, geometry):
+    gname = geometry_name(fname)
+    with open(gname + '.tmp', 'w') as f:
+        json.dump(geometry, f, indent=1)
+    os.rename(gname + '.tmp', gname)
+
+def read_geometry(fname):
+    '''The geometry of a response file; files from before it was recorded
+    have the default one.'''
+    try:
+        with open(geometry_name(fname), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'res': 16, 'pix': 23, 'st': 7}
+
+class Probes(object):
+    '''Builds occlusion probes for images of shape imshape.'''
+
+    def __init__(self, imshape, res=16, pix=23, st=7, seed=123):
+        if (res - 1) * st + pix > min(imshape[1:]):
+            raise ValueError('a {0}x{0} grid of {1} pixel patches {2} apart '
+                    'does not fit in {3}'.format(res, pix, st, imshape))
+        self.imshape = tuple(imshape)
+        self.seed = seed
+        self.res = res
+        self.pix = pix
+        self.st = st
+        self.noise = numpy.random.RandomState(seed).normal(size=[pix-4, pix-4])
+        # added to the inside of every patch
+        self.inner = numpy.zeros((pix, pix))
+        self.inner[2:pix-2, 2:pix-2] = self.noise + 10
+        # the pixels of every patch, in probe order
+        self.patches = [(slice(y * st, y * st + pix), slice(x * st, x * st + pix))
+                        for y in range(res) for x in range(res)]
+        self.out = None
+        self.windows = None
+
+    def count(self):
+        return self.res * self.res
+
+    def buffers(self, n, dtype):
+        if self.out is None or len(self.out) < n or self.out.dtype != dtype:
+            c, k, p = self.imshape[0], self.count(), self.pix
+            self.out = numpy.empty((n, k) + self.imshape, dtype=dtype)
+            self.boxes = numpy.empty((n, c, self.res, self.res, p, p))
+        return self.out[:n], self.boxes[:n]
+
+    def means(self, images):
+        '''The mean of every patch of images, plus a half, as an
+        (n, channels, res, res) array.'''
+        n, res, st, p = len(images), self.res, self.st, self.pix
+        if self.windows is None or len(self.windows) < n or \
+                self.windows.dtype != images.dtype:
+            self.windows = numpy.empty((n, self.imshape[0], res, res, p, p),
+                                       dtype=images.dtype)
+        windows = self.windows[:n]
+        windows[...] = sliding_window_view(images, (p, p),
+                axis=(2, 3))[:, :, :res*st:st, :res*st:st]
+        means = windows.reshape(windows.shape[:4] + (-1,)).mean(axis=-1)
+        # promote as adding 0.5 to a single mean would
+        return means.astype((means.dtype.type(0) + 0.5).dtype) + 0.5
+
+    def __call__(self, images):
+        '''Returns the probes of images, an (n,) + imshape float array, as
+        an (n * res * res,) + imshape array that is overwritten by the next
+        call.'''
+        n, res = len(images), self.res
+        out, boxes = self.buffers(n, images.dtype)
+        numpy.add(self.means(images)[..., None, None], self.inner, out=boxes)
+        numpy.remainder(boxes, 1, out=boxes)
+        out[...] = images[:, None]
+        for k, (ys, xs) in enumerate(self.patches):
+            out[:, k, :, ys, xs] = boxes[:, :, k // res, k % res]
+        return out.reshape((n * self.count(),) + self.imshape)
+
+    def select(self, images, means, which, patch):
+        '''Returns only probe patch[j] of image which[j], for every j, given
+        the means of images.'''
+        res = self.res
+        boxes = (means[which, :, patch // res, patch % res][..., None, None]
+                 + self.inner) % 1
+        out = images[which]
+        for k in numpy.unique(patch):
+            ys, xs = self.patches[k]
+            rows = numpy.nonzero(patch == k)[0]
+            out[rows, :, ys, xs] = boxes[rows]
+        return out
+
+    def geometry(self):
+        return {'res': self.res, 'pix': self.pix, 'st': self.st,
+                'seed': self.seed, 'imshape': list(self.imshape)}
+
+class Batches(object):
+    '''Runs rows through fn in batches of batchsize, carrying a part-filled
+    batch over from one add() to the next. Every row comes with a row of
+    integer tags, and done(tags, scores) is called for every batch run;
+    both are only good until it returns.'''
+
+    def __init__(self, fn, batchsize, shape, tags, done):
+        self.fn = fn
+        self.batchsize = batchsize
+        self.done = done
+        self.rows = numpy.empty((batchsize,) + tuple(shape), dtype=numpy.float32)
+        self.tags = numpy.empty((batchsize, tags), dtype=numpy.intp)
+        self.fill = 0
+
+    def add(self, rows, tags):
+        i, size = 0, self.batchsize
+        # top up the batch left over from last time first
+        if self.fill:
+            i = min(size - self.fill, len(rows))
+            self.rows[self.fill:self.fill + i] = rows[:i]
+            self.tags[self.fill:self.fill + i] = tags[:i]
+            self.fill += i
+            if self.fill == size:
+                self.fill = 0
+                self.done(self.tags, self.fn(self.rows))
+        while len(rows) - i >= size:
+            self.done(tags[i:i + size], self.fn(rows[i:i + size]))
+            i += size
+        if i < len(rows):
+            self.fill = len(rows) - i
+            self.rows[:self.fill] = rows[i:]
+            self.tags[:self.fill] = tags[i:]
+
+    def flush(self):
+        if self.fill:
+            fill, self.fill = self.fill, 0
+            self.done(self.tags[:fill], self.fn(self.rows[:fill]))
+
+class Engine(object):
+    '''Runs the probes of images through fn, which maps a batch of up to
+    batchsize probes to category scores, group images at a time. By
+    default a group is as few images as fill a batch; the batches carry
+    over between groups, so larger groups only cost memory.'''
+
+    def __init__(self, fn, imshape, batchsize, res=16, pix=23, st=7, group=None):
+        self.fn = fn
+        self.batchsize = batchsize
+        self.group = group or max(1, -(-batchsize // (res * res)))
+        self.probes = Probes(imshape, res, pix, st)
+
+    def geometry(self):
+        return dict(self.probes.geometry(), batchsize=self.batchsize)
+
+    def run(self, X, columns, outs, scale=None, progress=None):
+        '''Writes into outs[t][i] the response of category columns[i, t]
+        to every probe of image X[i], for the first len(columns) images.
+        Images are divided by scale, if given.'''
+        cases, k = len(columns), self.probes.count()
+        columns = numpy.asarray(columns, dtype=numpy.intp)
+        flat = [out.reshape(-1) for out in outs]
+        def done(tags, pred):
+            index = tags[:, 0]
+            picked = numpy.take_along_axis(pred, columns[index // k], axis=1)
+            for t, out in enumerate(flat):
+                out[index] = picked[:, t]
+        batches = Batches(self.fn, self.batchsize, self.probes.imshape, 1, done)
+        for start in range(0, cases, self.group):
+            images = X[start:min(start + self.group, cases)]
+            if scale is not None:
+                images = images / numpy.float32(scale)
+            rows = numpy.arange(start * k, (start + len(images)) * k)
+            batches.add(self.probes(images), rows[:, None])
+            if progress is not None:
+                progress.update(start + len(images))
+        batches.flush()
+
+class Adaptive(object):
+    '''Like Engine, but occludes coarse to fine. It starts on a grid of
+    blocks of coarse x coarse patches, each block occluded by one patch
+    covering it, and only splits a block in four when occluding it moves
+    the score of some target by more than threshold. Patches in blocks
+    that are not split take the response of their block, so the responses
+    come out on the same grid as Engine's, from fewer forward passes.
+
+    Each block is split as soon as its own score is in, and the probes of
+    every level and of every group of images share the same batches. Once
+    every group has been admitted, each level still to refine has to wait
+    for the scores of the one before it, so the tail of a run goes through
+    as one part-filled batch per remaining level.'''
+
+    # tags of a row: group, image in the group, level (BASE for the image
+    # itself), and the block's position on that level's grid
+    BASE = -1
+
+    def __init__(self, fn, imshape, batchsize, res=16, pix=23, st=7,
+                 coarse=4, threshold=0.01, group=32):
+        if coarse < 1 or coarse & (coarse - 1) or res % coarse:
+            raise ValueError('the coarse block size must be a power of two '
+                    'dividing the grid size {}, not {}'.format(res, coarse))
+        self.fn = fn
+        self.batchsize = batchsize
+        self.imshape = tuple(imshape)
+        self.res = res
+        self.coarse = coarse
+        self.threshold = threshold
+        self.group = group
+        # blocks of size s are occluded by a patch covering all of theirs
+        self.levels = []
+        s = coarse
+        while s >= 1:
+            self.levels.append((s, Probes(imshape, res // s,
+                    pix + (s - 1) * st, st * s)))
+            s //= 2
+        self.probes = self.levels[-1][1]
+        # occlusion probes run, not counting the images themselves
+        self.passes = 0
+
+    def geometry(self):
+        return dict(self.probes.geometry(), batchsize=self.batchsize,
+                    mode='adaptive', coarse=self.coarse,
+                    threshold=self.threshold)
+
+    def add(self, batches, g, group, which, level, y, x):
+        '''Queues the probes of blocks (y, x) of level for images which.'''
+        if not len(which):
+            return
+        s, probes = self.levels[level]
+        rows = probes.select(group['images'], group['means'][level],
+                             which, y * probes.res + x)
+        tags = numpy.stack([numpy.full(len(which), g), which,
+                            numpy.full(len(which), level), y, x], axis=1)
+        group['pending'] += numpy.bincount(which, minlength=len(group['pending']))
+        self.passes += len(which)
+        batches.add(rows, tags)
+
+    def run(self, X, columns, outs, scale=None, progress=None):
+        '''Writes into outs[t][i] the response of category columns[i, t]
+        to every probe of image X[i], as Engine.run does.'''
+        cases, res = len(columns), self.res
+        columns = numpy.asarray(columns, dtype=numpy.intp)
+        groups = {}
+        results = []
+        finished = [0]
+        def done(tags, pred):
+            results.append((tags.copy(), pred))
+        batches = Batches(self.fn, self.batchsize, self.imshape, 5, done)
+
+        def settle():
+            # take in every score so far, which may queue finer blocks and
+            # run more batches in turn
+            while results:
+                tags, pred = results.pop(0)
+                for g in numpy.unique(tags[:, 0]):
+                    group = groups[g]
+                    mine = tags[tags[:, 0] == g]
+                    which, level = mine[:, 1], mine[:, 2]
+                    picked = numpy.take_along_axis(pred[tags[:, 0] == g],
+                            group['columns'][which], axis=1)
+                    base = level == self.BASE
+                    group['base'][which[base]] = picked[base]
+                    group['pending'] -= numpy.bincount(which,
+                            minlength=len(group['pending']))
+                    for l in numpy.unique(level[~base]):
+                        self.refine(batches, g, group, mine[level == l],
+                                    picked[level == l])
+                    complete(g, group)
+
+        def complete(g, group):
+            done = numpy.nonzero((group['pending'] == 0) & ~group['written'])[0]
+            for t, out in enumerate(outs):
+                out[group['start'] + done] = \
+                        group['response'][done, t].reshape(len(done), res * res)
+            group['written'][done] = True
+            finished[0] += len(done)
+            if progress is not None and len(done):
+                progress.update(finished[0])
+            if group['written'].all():
+                del groups[g]
+
+        for g, start in enumerate(range(0, cases, self.group)):
+            images = X[start:min(start + self.group, cases)]
+            if scale is not None:
+                images = images / numpy.float32(scale)
+            images = numpy.asarray(images, dtype=numpy.float32)
+            n = len(images)
+            group = groups[g] = {
+                'start': start,
+                'images': images,
+                'columns': columns[start:start + n],
+                'means': [probes.means(images) for _, probes in self.levels],
+                'base': numpy.empty((n, columns.shape[1]), dtype=numpy.float32),
+                'response': numpy.empty((n, columns.shape[1], res, res),
+                                        dtype=numpy.float32),
+                'pending': numpy.full(n, 1, dtype=numpy.intp),
+                'written': numpy.zeros(n, dtype=bool),
+            }
+            batches.add(images, numpy.stack([numpy.full(n, g), numpy.arange(n),
+                    numpy.full(n, self.BASE), numpy.zeros(n, dtype=numpy.intp),
+                    numpy.zeros(n, dtype=numpy.intp)], axis=1))
+            # every block of the coarsest level
+            grid = res // self.coarse
+            self.add(batches, g, group, numpy.repeat(numpy.arange(n), grid * grid),
+                     0, numpy.tile(numpy.repeat(numpy.arange(grid), grid), n),
+                     numpy.tile(numpy.arange(grid), n * grid))
+            settle()
+        while groups:
+            batches.flush()
+            settle()
+
+    def refine(self, batches, g, group, tags, picked):
+        '''Records the scores of blocks of one level, and queues the four
+        blocks of the next level in each block that matters.'''
+        which, level, y, x = tags[:, 1], tags[0, 2], tags[:, 3], tags[:, 4]
+        s = self.levels[level][0]
+        response = group['response']
+        for dy in range(s):
+            for dx in range(s):
+                response[which, :, y * s + dy, x * s + dx] = picked
+        if s == 1:
+            return
+        split = (numpy.abs(picked - group['base'][which]) >
+                 self.threshold).any(axis=1)
+        which, y, x = which[split], y[split], x[split]
+        self.add(batches, g, group, numpy.repeat(which, 4), level + 1,
+                 numpy.repeat(y * 2, 4) + numpy.tile([0, 0, 1, 1], len(y)),
+                 numpy.repeat(x * 2, 4) + numpy.tile([0, 1, 0, 1], len(x)))
@@ -0,0 +1,138 @@
+import mmap
+import multiprocessing
+import numpy
+
+# Synchronous data-parallel training on one machine. The process that
+# builds the network forks workers that share its compiled functions. For
+# every batch, each process computes the gradient on its own slice of the
+# batch, the gradients are averaged in shared memory, and the parent alone
+# applies the update and publishes the new parameters for the next batch.
+
+def shared_empty(shape, dtype):
+    '''Like numpy.empty, but in anonymous shared memory, so that processes
+    forked afterwards see the same array.'''
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return numpy.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+class DataParallel(object):
+    '''Runs training steps over workers processes, the caller included.
+
+    grad_fn(flip, crop, X, y) returns the loss, the top 1 and top 5 hit
+    counts and the gradient of every trainable parameter, for the images
+    it is given. apply_fn(lr, *grads) applies the update. state are the
+    parameters that are not trained but change in training anyway, like
+    batch norm statistics; each worker's values are averaged after every
+    step. reseed(w) is called in each new worker, to give it random
+    streams of its own.
+
+    Call sync() whenever the parameters are set from outside.
+    '''
+
+    def __init__(self, workers, grad_fn, apply_fn, params, state,
+                 batchsize, imshape, dtype, reseed=None):
+        self.workers = workers
+        self.grad_fn = grad_fn
+        self.apply_fn = apply_fn
+        self.params = params
+        self.state = state
+        self.X = shared_empty((batchsize,) + tuple(imshape), dtype)
+        self.y = shared_empty((batchsize,), numpy.int32)
+        values = [p.get_value(borrow=True) for p in params + state]
+        self.P = [shared_empty(v.shape, v.dtype) for v in values]
+        self.G = [[shared_empty(p.get_value(borrow=True).shape, p.dtype)
+                   for p in params] for _ in range(workers)]
+        self.S = [[shared_empty(p.get_value(borrow=True).shape, p.dtype)
+                   for p in state] for _ in range(workers)]
+        self.sync()
+
+        ctx = multiprocessing.get_context('fork')
+        self.pipes = []
+        self.procs = []
+        for w in range(1, workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=self.serve, args=(w, child, reseed))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self.pipes.append(parent)
+            self.procs.append(proc)
+
+    def sync(self):
+        for P, p in zip(self.P, self.params + self.state):
+            P[...] = p.get_value(borrow=True)
+
+    def serve(self, w, pipe, reseed):
+        if reseed is not None:
+            reseed(w)
+        while True:
+            msg = pipe.recv()
+            if msg is None:
+                return
+            pipe.send(self.compute(w, *msg))
+
+    def compute(self, w, flip, crop, start, stop):
+        if w:
+            # Take up the parameters the parent published after the last
+            # step; the parent's own are current already.
+            for p, P in zip(self.params + self.state, self.P):
+                p.set_value(P)
+        if stop <= start:
+            for G in self.G[w]:
+                G.fill(0)
+            for S, p in zip(self.S[w], self.state):
+                S[...] = p.get_value(borrow=True)
+            return 0.0, 0.0, 0.0
+        out = self.grad_fn(flip, crop, self.X[start:stop], self.y[start:stop])
+        for G, g in zip(self.G[w], out[3:]):
+            G[...] = g
+        for S, p in zip(self.S[w], self.state):
+            S[...] = p.get_value(borrow=True)
+        return float(out[0]), float(out[1]), float(out[2])
+
+    def step(self, lr, flip, crop, X, y):
+        '''Trains on one batch, with the same arguments and results as a
+        train_fn compiled with the update built in.'''
+        n = len(y)
+        self.X[:n] = X
+        self.y[:n] = y
+        bounds = [n * w // self.workers for w in range(self.workers + 1)]
+        crop = numpy.asarray(crop, dtype=numpy.int32).copy()
+        for w, pipe in enumerate(self.pipes, 1):
+            pipe.send((flip, crop, bounds[w], bounds[w + 1]))
+        results = [self.compute(0, flip, crop, bounds[0], bounds[1])]
+        results += [pipe.recv() for pipe in self.pipes]
+
+        # Each slice's mean gradient, weighted by its share of the batch,
+        # adds up to the mean gradient of the whole batch.
+        weights = [(bounds[w + 1] - bounds[w]) / max(n, 1)
+                   for w in range(self.workers)]
+        grads = self.G[0]
+        for G in grads:
+            G *= weights[0]
+        for w in range(1, self.workers):
+            for G, g in zip(grads, self.G[w]):
+                G += weights[w] * g
+        self.apply_fn(lr, *grads)
+
+        for k, p in enumerate(self.state):
+            S = self.S[0][k] * weights[0]
+            for w in range(1, self.workers):
+                S += weights[w] * self.S[w][k]
+            p.set_value(S.astype(p.dtype))
+        self.sync()
+
+        loss = sum(weights[w] * results[w][0] for w in range(self.workers))
+        hits1 = sum(r[1] for r in results)
+        hits5 = sum(r[2] for r in results)
+        return loss, hits1, hits5
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(None)
+            except (BrokenPipeError, EOFError):
+                pass
+        for proc in self.procs:
+            proc.join()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import checkpoint
 import numpy
 import sys
 import re
@@ -44,26 +45,16 @@ validation = []
 
 for model in args.model:
     try:
-        import pickle
-        model.seek(0)
-        formatver = pickle.load(model)
-        if type(formatver) != int:
-            formatver = 0
-            model.seek(0)
-
-        # add imports for unpickle to work
-        import lasagne
-        import theano
-        pickle.load(model)  # state
+        stored = checkpoint.load(model, params=False)
 
         # the things we actually care about
-        epoch = pickle.load(model)
+        epoch = stored['epoch']
         if epoch > maxe:
             maxe = epoch
 
-        training.append(pickle.load(model))
-        validation.append(pickle.load(model))
-    except EOFError:
+        training.append(stored['training'])
+        validation.append(stored['validation'])
+    except (EOFError, ValueError):
         print("Model {} is invalid".format(model.name))
         sys.exit(1)
 
@@ -0,0 +1,121 @@
+import checkpoint
+import dataset
+import hashlib
+import json
+import numpy
+import os
+import os.path
+import time
+
+# Predictions are kept in a store in the run directory, under a name that
+# is a hash of what they were computed from: the parameters of the model,
+# the image set, and the evaluation settings. The usual file names, like
+# val.confusion.db, are symbolic links into the store, so the tools that
+# read them work as before, while predictions for another checkpoint or
+# setting live side by side and are found again instead of recomputed.
+#
+# Every entry has a JSON description next to it, written last, so that an
+# entry without one is incomplete and is never used. Tools that cannot
+# compute predictions themselves use check() to tell whether the linked
+# entry was made from the latest checkpoint and the current image set.
+
+STORE = 'predictions'
+
+class Stale(Exception):
+    pass
+
+def params_digest(arrays):
+    digest = hashlib.sha1()
+    for a in arrays:
+        a = numpy.ascontiguousarray(a)
+        digest.update(repr((a.dtype.str, a.shape)).encode('utf-8'))
+        digest.update(memoryview(a).cast('B'))
+    return digest.hexdigest()
+
+def dataset_digest(tagged, subset):
+    header = dataset.read_header(tagged, subset)
+    digest = hashlib.sha1()
+    digest.update(json.dumps(header, sort_keys=True).encode('utf-8'))
+    with open(os.path.join(tagged, header['filenames']), 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def key(arrays, tagged, subset, settings):
+    '''Describes the predictions of a model with parameters arrays on
+    subset, evaluated with settings, a dict of JSON values.'''
+    parts = {
+        'params': params_digest(arrays),
+        'dataset': dataset_digest(tagged, subset),
+        'subset': subset,
+        'settings': settings,
+    }
+    parts['digest'] = hashlib.sha1(json.dumps(parts, sort_keys=True)
+                                   .encode('utf-8')).hexdigest()
+    return parts
+
+def entry(outdir, digest):
+    return os.path.join(outdir, STORE, digest + '.db')
+
+def describe(fname):
+    '''The description of the store entry fname, or None if it has none.'''
+    try:
+        with open(os.path.splitext(fname)[0] + '.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def lookup(outdir, key, shape):
+    '''Maps the stored predictions for key read-only, or returns None.'''
+    fname = entry(outdir, key['digest'])
+    found = describe(fname)
+    if found is None or found.get('digest') != key['digest'] or \
+            found.get('shape') != list(shape) or not os.path.exists(fname):
+        return None
+    return numpy.memmap(fname, dtype=numpy.float32, mode='r', shape=shape)
+
+def create(outdir, key, shape):
+    '''A writable memmap for the predictions for key; pass it to commit()
+    once it is filled in.'''
+    os.makedirs(os.path.join(outdir, STORE), exist_ok=True)
+    tmp = entry(outdir, key['digest']) + '.tmp'
+    return numpy.memmap(tmp, dtype=numpy.float32, mode='w+', shape=shape)
+
+def commit(outdir, key, out, **info):
+    fname = entry(outdir, key['digest'])
+    out.flush()
+    shape = list(out.shape)
+    del out
+    os.rename(fname + '.tmp', fname)
+    description = dict(key, shape=shape, created=time.time(), **info)
+    jname = os.path.splitext(fname)[0] + '.json'
+    with open(jname + '.tmp', 'w') as f:
+        json.dump(description, f, indent=1)
+    os.rename(jname + '.tmp', jname)
+    return numpy.memmap(fname, dtype=numpy.float32, mode='r',
+                        shape=tuple(shape))
+
+def publish(outdir, key, name):
+    '''Points the well-known file name in outdir at the entry for key.'''
+    link = os.path.join(outdir, name)
+    target = os.path.join(STORE, key['digest'] + '.db')
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(target, link)
+
+def check(outdir, name, tagged, subset):
+    '''Raises Stale unless outdir/name is a complete store entry made from
+    the latest checkpoint in outdir and the current image set.'''
+    fname = os.path.join(outdir, name)
+    found = describe(os.path.realpath(fname)) \
+        if os.path.islink(fname) else None
+    if found is None:
+        raise Stale('{} does not say what it was computed from'.format(fname))
+    if found['dataset'] != dataset_digest(tagged, subset):
+        raise Stale('{} was computed on another {} set'.format(fname, subset))
+    caches = checkpoint.epochs(outdir)
+    if caches:
+        latest = checkpoint.load(caches[max(caches)])
+        if found['params'] != params_digest(latest['params']):
+            raise Stale('{} was not computed from {}'.format(
+                    fname, caches[max(caches)]))
+    return found
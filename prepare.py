@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 
 from pretty import *
+import collections
+import dataset
 import scipy.ndimage
 import argparse
+import itertools
 import os.path
+import multiprocessing
+import tarfile
 import numpy
 import sys
+import io
 import os
 
 parser = argparse.ArgumentParser()
-parser.add_argument('images', help='path to images/')
+parser.add_argument('images', help='path to images/, or to data.tar.gz to read the images straight from the archive')
 parser.add_argument('devkit', help="path to dev kit's data/")
 parser.add_argument('outdir', help='path to directory in which to place serialized data files')
 parser.add_argument('-c', '--categories', type=int, help='limit number of categories to sample', default=0)
 parser.add_argument('-s', '--samples', type=int, help='limit number of images to sample per category', default=0)
+parser.add_argument('-j', '--jobs', type=int, help='number of worker processes decoding images', default=1)
+parser.add_argument('--dtype', help='store pixels as floats in [0, 1] or as raw bytes', choices=['float32', 'uint8'], default='float32')
+parser.add_argument('--shard-size', type=int, help='number of images in each shard file', default=4096)
+parser.add_argument('--prefix', help='directory holding the images inside the archive', default='images')
+parser.add_argument('-f', '--force', help='ignore the manifest and decode every image again', action='store_true')
+parser.set_defaults(force=False)
 args = parser.parse_args()
 
 # Pick a constant random seed so that the shuffle is deterministic.
@@ -21,13 +33,251 @@ args = parser.parse_args()
 # simplifying the data we need for analysis.
 seed = 1
 
-def dir2nd(directory, nsamples=0):
+# Number of images handed to a worker at a time when decoding in parallel.
+chunksize = 64
+
+# Images are either read from a path, or from the bytes of an archive member.
+def load_image(source, dtype):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    im = numpy.transpose(scipy.ndimage.imread(source), [2, 0, 1])
+    if dtype == numpy.uint8:
+        # Raw bytes; the readers scale them into [0, 1] themselves.
+        return im
+    return im / 255.0
+
+def decode_chunk(chunk):
+    header, suffix, jobs = chunk
+    imdb = dataset.Images(args.outdir, header, 'r+', suffix)
+    for slot, source, _, _, _, _ in jobs:
+        imdb[slot] = load_image(source, imdb.dtype)
+    imdb.flush()
+    del imdb
+    # No need to send the image data back
+    return [(slot, None, rel, size, mtime, cat)
+            for slot, _, rel, size, mtime, cat in jobs]
+
+# The manifest records which slots of an image set hold which source
+# image. Its first line describes the layout (image count, dtype and shard
+# size). Each following line is either "slot size mtime label path" for a
+# slot whose pixels are safely on disk, or "slot -" for a slot that is
+# about to be overwritten. Later lines override earlier ones.
+def read_manifest(mfname):
+    try:
+        mf = open(mfname, 'r')
+    except FileNotFoundError:
+        return None, {}
+    slots = {}
+    with mf:
+        layout = mf.readline().split()
+        for line in mf:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 5:
+                slot, size, mtime, cat, rel = fields
+                slots[int(slot)] = (rel, int(size), int(mtime), int(cat))
+            elif fields[1:] == ['-']:
+                slots.pop(int(fields[0]), None)
+            # anything else is a line torn by an interrupted run
+    return layout, slots
+
+def manifest_line(slot, rel, size, mtime, cat):
+    return "{}\t{}\t{}\t{}\t{}\n".format(slot, size, mtime, cat, rel)
+
+def manifest_lines(entries):
+    return [manifest_line(slot, rel, size, mtime, cat)
+            for slot, _, rel, size, mtime, cat in entries]
+
+def write_manifest(mfname, layout, slots):
+    # Start every run from a compacted copy, which also gets rid of any
+    # torn line at the end.
+    with open(mfname + '.tmp', 'w') as mf:
+        mf.write(' '.join(layout) + '\n')
+        for slot, entry in sorted(slots.items()):
+            mf.write(manifest_line(slot, *entry))
+    os.rename(mfname + '.tmp', mfname)
+
+# Set up in the main section when decoding with several workers.
+pool = None
+
+def previous_images(directory, oldlayout):
+    '''Opens the images of the set as it was last prepared.'''
+    if os.path.exists(dataset.index_name(args.outdir, directory)):
+        return dataset.open_images(args.outdir, directory)
+    # A set from before the index is a single images file. Its size comes
+    # from the old manifest, since select() has rewritten the labels file
+    # for the new set by now.
+    count = int(oldlayout[0])
+    header = dataset.make_header(directory, count, oldlayout[1],
+            (3, 128, 128), None, max(count, 1))
+    header['shards'] = [{'file': directory + '.images.db', 'start': 0, 'stop': count}]
+    return dataset.Images(args.outdir, header)
+
+class ImageSet(object):
+    '''Writes the images of one set into its shards.
+
+    Images are handed to add() one at a time, in any order, as
+    (slot, source, path, size, mtime, label) entries. Images that the
+    manifest says are already in place are skipped, images that an older
+    layout of the set holds are copied across, and the rest are decoded in
+    chunks, either here or on the worker pool.
+    '''
+
+    def __init__(self, directory, N, categories, bar=None):
+        self.directory = directory
+        self.bar = bar
+        self.processed = 0
+        self.reused = 0
+        self.mfname = os.path.join(args.outdir, directory) + '.manifest.txt'
+        dtype = numpy.dtype(args.dtype)
+        self.header = dataset.make_header(directory, N, dtype, (3, 128, 128),
+                categories, args.shard_size)
+        layout = [str(N), dtype.name, str(args.shard_size)]
+        if args.force:
+            for stale in [self.mfname, self.mfname + '.part']:
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+        # If the layout is unchanged, we can update the shards in place.
+        # Otherwise we build new ones next to them, and copy over every
+        # image that the old set already holds.
+        oldlayout, self.done = read_manifest(self.mfname)
+        self.prev = {}
+        self.prevdb = None
+        if oldlayout == layout and self.complete(''):
+            self.suffix, self.outmf = '', self.mfname
+            mode = 'r+'
+        else:
+            if oldlayout is not None and oldlayout[1] == layout[1]:
+                self.prevdb = previous_images(directory, oldlayout)
+                self.prev = dict((rel, (slot, size, mtime, cat)) for slot, (rel, size, mtime, cat) in self.done.items())
+            self.suffix, self.outmf = '.part', self.mfname + '.part'
+            partlayout, self.done = read_manifest(self.outmf)
+            mode = 'r+'
+            if partlayout != layout or not self.complete(self.suffix):
+                self.done = {}
+                mode = 'w+'
+
+        self.imdb = dataset.Images(args.outdir, self.header, mode, self.suffix)
+        # Map every shard once so that new ones are created before the
+        # workers open them.
+        for i in range(len(self.header['shards'])):
+            self.imdb.shard(i)
+        self.imdb.flush()
+        write_manifest(self.outmf, layout, self.done)
+        self.mf = open(self.outmf, 'a')
+        self.copies = []
+        self.jobs = []
+        self.pending = collections.deque()
+
+    def complete(self, suffix):
+        return all(os.path.exists(os.path.join(args.outdir, s['file'] + suffix))
+                   for s in self.header['shards'])
+
+    def advance(self, n):
+        self.processed += n
+        if self.bar is not None:
+            self.bar.update(self.processed)
+
+    def claim(self, entries):
+        # Claim every slot before overwriting it, so that an interrupted run
+        # never trusts a half-written slot.
+        self.mf.writelines(["{}\t-\n".format(entry[0]) for entry in entries])
+        self.mf.flush()
+
+    def record(self, entries):
+        self.mf.writelines(manifest_lines(entries))
+        self.mf.flush()
+        self.advance(len(entries))
+
+    def add(self, entry):
+        slot, source, rel, size, mtime, cat = entry
+        if self.done.get(slot) == (rel, size, mtime, cat):
+            self.reused += 1
+            self.advance(1)
+        elif self.prev.get(rel, (None,))[1:] == (size, mtime, cat):
+            self.reused += 1
+            self.copies.append((self.prev[rel][0], entry))
+            if len(self.copies) == chunksize:
+                self.copy()
+        else:
+            self.jobs.append(entry)
+            if len(self.jobs) == chunksize:
+                self.submit()
+
+    def copy(self):
+        entries = [entry for _, entry in self.copies]
+        self.claim(entries)
+        for pslot, entry in self.copies:
+            self.imdb[entry[0]] = self.prevdb[pslot]
+        self.imdb.flush()
+        self.record(entries)
+        self.copies = []
+
+    def submit(self):
+        # Workers map the shards themselves and write their images straight
+        # into their slots; the manifest is only updated once a whole chunk
+        # is on disk.
+        chunk = (self.header, self.suffix, self.jobs)
+        self.claim(self.jobs)
+        self.jobs = []
+        if pool is None:
+            self.record(decode_chunk(chunk))
+            return
+        # Bound the number of chunks in flight, so that a fast reader (such
+        # as an archive stream) cannot pile up images in memory.
+        while len(self.pending) >= 2 * args.jobs:
+            self.record(self.pending.popleft().get())
+        self.pending.append(pool.apply_async(decode_chunk, (chunk,)))
+
+    def finish(self):
+        if self.copies:
+            self.copy()
+        if self.jobs:
+            self.submit()
+        while self.pending:
+            self.record(self.pending.popleft().get())
+        if self.bar is not None:
+            self.bar.finish()
+        self.mf.close()
+        del self.imdb
+        del self.prevdb
+
+        if self.suffix:
+            # Move the finished shards into place. Drop the old manifest and
+            # index first, so that an interruption in between can never pair
+            # them with the new shards.
+            for stale in [self.mfname, dataset.index_name(args.outdir, self.directory)]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+            for s in self.header['shards']:
+                shard = os.path.join(args.outdir, s['file'])
+                os.rename(shard + self.suffix, shard)
+            # Clean up after older layouts: shards past the new end, and the
+            # single images file that predates sharding.
+            current = set(s['file'] for s in self.header['shards'])
+            for name in os.listdir(args.outdir):
+                if name.startswith(self.directory + '.images') and name.endswith('.db') and name not in current:
+                    os.remove(os.path.join(args.outdir, name))
+        dataset.write_header(args.outdir, self.directory, self.header)
+        if self.suffix:
+            os.rename(self.outmf, self.mfname)
+        if self.reused:
+            subtask("Reused {} of {} images".format(self.reused, self.header['count']))
+
+def select(directory, nsamples, listing):
+    '''Picks the images of a set to extract and assigns each its slot.
+
+    listing holds (path, source) pairs for every image of the set, grouped
+    by directory, in the order they are found. Returns the number of slots,
+    the number of categories, and a (slot, source, path, label) entry for
+    each image picked, or None if the set is empty.
+    '''
     global args
 
     # Count images
-    N = sum([len(files) for _, _, files in os.walk(os.path.join(args.images, directory), followlinks=True)])
+    N = len(listing)
     if not N:
-        return
+        return None
 
     # Grab label map
     Ncat = None
@@ -54,23 +304,22 @@ def dir2nd(directory, nsamples=0):
     elif nsamples != 0:
         limit = Ncat * nsamples
     if limit < N:
-        N = limit
+        N = int(limit)
     if directory != "train":
         nsamples = N
 
     remap = numpy.arange(N)
     numpy.random.RandomState(seed).shuffle(remap)
 
+    # Decide which image lands in which slot before decoding anything, so
+    # that the decoding itself can be spread over several workers.
     i = 0
-    p = progress(N, redirect_stdout=True)
-    imdb = numpy.memmap(os.path.join(args.outdir, directory) + '.images.db', dtype=numpy.float32, mode='w+', shape=(N, 3, 128, 128))
+    entries = []
     lbdb = numpy.memmap(os.path.join(args.outdir, directory) + '.labels.db', dtype=numpy.int32, mode='w+', shape=(N, ))
     nmlist = [None] * N
-    for root, dirs, files in os.walk(os.path.join(args.images, directory), followlinks=True):
+    for _, group in itertools.groupby(listing, key=lambda l: os.path.dirname(l[0])):
         imgs = 0
-        for img in files:
-            impath = os.path.join(root, img)
-            rel = os.path.relpath(impath, args.images)
+        for rel, source in group:
             cat = None
             if labels is not None:
                 cat = int(labels[rel])
@@ -83,12 +332,11 @@ def dir2nd(directory, nsamples=0):
                 # number of categories.
                 continue
 
-            imdb[remap[i]] = numpy.transpose(scipy.ndimage.imread(impath), [2, 0, 1]) / 255.0
             lbdb[remap[i]] = cat is None and -1 or cat
+            entries.append((int(remap[i]), source, rel, int(lbdb[remap[i]])))
             nmlist[remap[i]] = rel
 
             i += 1
-            p.update(i)
 
             imgs += 1
             # Note that there is no need for a check on nsamples != 0 here,
@@ -96,20 +344,120 @@ def dir2nd(directory, nsamples=0):
             # test set, we extract all images.
             if imgs == nsamples:
                 break
-    p.finish()
+
+    categories = None
+    if labels is not None:
+        categories = int(numpy.max(lbdb)) + 1
     with open(os.path.join(args.outdir, directory)+'.filenames.txt', 'w') as f:
         f.writelines([name + '\n' for name in nmlist])
-    del imdb
     del lbdb
-    return (N, remap)
+    return N, categories, entries
+
+def dir2nd(directory, nsamples=0):
+    global args
+
+    listing = []
+    for root, dirs, files in os.walk(os.path.join(args.images, directory), followlinks=True):
+        for img in files:
+            impath = os.path.join(root, img)
+            listing.append((os.path.relpath(impath, args.images), impath))
+
+    selected = select(directory, nsamples, listing)
+    if selected is None:
+        return
+    N, categories, entries = selected
+    imset = ImageSet(directory, N, categories, progress(len(entries), redirect_stdout=True))
+    for slot, impath, rel, cat in entries:
+        st = os.stat(impath)
+        imset.add((slot, impath, rel, st.st_size, st.st_mtime_ns, cat))
+    imset.finish()
+
+def tar2nd(subsets):
+    global args
+
+    # Sets with a label file list all their images up front, so their slots
+    # are known before the archive is read and their members are decoded as
+    # they stream past. Members of the other sets (the test images) are
+    # held back until the end of the archive tells us how many there are.
+    imsets = collections.OrderedDict()
+    wanted = {}
+    spooled = collections.OrderedDict()
+    for directory, nsamples in subsets:
+        try:
+            with open(os.path.join(args.devkit, directory) + '.txt', 'r') as lmap:
+                listing = [(line.split(' ', 1)[0], None) for line in lmap]
+        except FileNotFoundError:
+            spooled[directory] = (nsamples, [])
+            continue
+        # Keep the images of each directory together, as a walk would.
+        listing.sort(key=lambda l: os.path.dirname(l[0]))
+        selected = select(directory, nsamples, listing)
+        if selected is None:
+            continue
+        N, categories, entries = selected
+        imsets[directory] = ImageSet(directory, N, categories)
+        for slot, _, rel, cat in entries:
+            wanted[rel] = (directory, slot, cat)
+
+    # The progress bar follows our position in the compressed archive.
+    with open(args.images, 'rb') as raw:
+        p = progress(os.path.getsize(args.images), redirect_stdout=True)
+        with tarfile.open(fileobj=raw, mode='r|*') as tar:
+            for member in tar:
+                p.update(raw.tell())
+                if not member.isfile():
+                    continue
+                rel = os.path.relpath(os.path.normpath(member.name), args.prefix)
+                directory = rel.split(os.sep)[0]
+                mtime = int(member.mtime) * 1000000000
+                if rel in wanted:
+                    directory, slot, cat = wanted.pop(rel)
+                    data = tar.extractfile(member).read()
+                    imsets[directory].add((slot, data, rel, member.size, mtime, cat))
+                elif directory in spooled:
+                    data = tar.extractfile(member).read()
+                    spooled[directory][1].append((rel, data, member.size, mtime))
+        p.finish()
+
+    for directory, imset in imsets.items():
+        missing = sum(1 for d, _, _ in wanted.values() if d == directory)
+        if missing:
+            subtask("{} {} images were not found in the archive".format(missing, directory))
+        imset.finish()
+
+    for directory, (nsamples, members) in spooled.items():
+        members.sort(key=lambda m: os.path.dirname(m[0]))
+        selected = select(directory, nsamples, [(rel, data) for rel, data, _, _ in members])
+        if selected is None:
+            continue
+        subtask("Decoding {} images held back from the archive".format(directory))
+        N, categories, entries = selected
+        stats = dict((rel, (size, mtime)) for rel, _, size, mtime in members)
+        imset = ImageSet(directory, N, categories, progress(len(entries), redirect_stdout=True))
+        for slot, data, rel, cat in entries:
+            imset.add((slot, data, rel) + stats[rel] + (cat,))
+        imset.finish()
+
+if args.jobs > 1:
+    # Fork explicitly: this script has no __main__ guard, so a spawned
+    # worker would rerun the whole preparation.
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
 
 section("Dataset preparation")
 
-task("Extracting training images")
-dir2nd("train", nsamples=args.samples)
+if os.path.isdir(args.images):
+    task("Extracting training images")
+    dir2nd("train", nsamples=args.samples)
+
+    task("Extracting validation images")
+    dir2nd("val", nsamples=int(args.samples/10))
 
-task("Extracting validation images")
-dir2nd("val", nsamples=int(args.samples/10))
+    task("Extracting test images")
+    dir2nd("test", nsamples=0)
+else:
+    task("Extracting images from {}".format(args.images))
+    tar2nd([("train", args.samples), ("val", int(args.samples/10)), ("test", 0)])
 
-task("Extracting test images")
-dir2nd("test", nsamples=0)
+if pool is not None:
+    pool.close()
+    pool.join()
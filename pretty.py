@@ -1,6 +1,7 @@
 from termcolor import colored
 import datetime
 import sys
+import time
 
 def section(msg):
     print(colored("\n::", "blue", attrs=["bold"]), colored(msg, attrs=["bold"]), file=sys.stderr)
@@ -35,5 +36,26 @@ class AbsoluteETABrief(Timer):
                          data['total_seconds_elapsed'])
 
 
-def progress(number, **kwargs):
-    return ProgressBar(max_value=number, widgets=[Percentage(), ' (', SimpleProgress(), ') ', Bar(), ' ', Timer(), ' ', AbsoluteETABrief()], **kwargs).start()
+class Throttled(object):
+    '''Passes updates on to a progress bar at most once every interval
+    seconds, and always the last one, since redrawing costs time too.'''
+
+    def __init__(self, bar, interval):
+        self.bar = bar
+        self.interval = interval
+        self.last = 0
+
+    def update(self, value):
+        now = time.time()
+        if now - self.last >= self.interval or value >= self.bar.max_value:
+            self.bar.update(value)
+            self.last = now
+
+    def finish(self):
+        self.bar.finish()
+
+def progress(number, interval=0, **kwargs):
+    bar = ProgressBar(max_value=number, widgets=[Percentage(), ' (', SimpleProgress(), ') ', Bar(), ' ', Timer(), ' ', AbsoluteETABrief()], **kwargs).start()
+    if interval:
+        return Throttled(bar, interval)
+    return bar
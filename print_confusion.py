@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+import confusion
+import dataset
 import numpy
+import prediction
 import re
+import sys
 import os
 import os.path
 
@@ -12,6 +16,10 @@ parser.add_argument('-d', '--devkit', help='devkit directory containing categori
 parser.add_argument('-o', '--outdir', help='store trained network state in this directory', default=None)
 parser.add_argument('-n', '--network', help='name of network experiment', default='base')
 parser.add_argument('-s', '--subset', help='train or val', default='train')
+parser.add_argument('--stale-ok', help='use predictions even if they may not be from the latest checkpoint', action='store_true')
+parser.set_defaults(stale_ok=False)
+parser.add_argument('--summary', help='print accuracy and the most confused categories instead of every image', action='store_true')
+parser.set_defaults(summary=False)
 args = parser.parse_args()
 
 if args.outdir is None:
@@ -30,23 +38,40 @@ for line in open(os.path.join(
     name, label = line.strip().split()
     labels[name] = int(label)
 
+header = dataset.read_header(args.tagged, args.subset)
 filenames = [line.strip() for line in open(os.path.join(
-        args.tagged, '%s.filenames.txt' % args.subset)).readlines()]
-cases = len(filenames)
+        args.tagged, header['filenames'])).readlines()]
+cases = header['count']
 
-confusion_file = open(os.path.join(args.outdir,
-    '%s.confusion.db' % args.subset), 'r')
-predictions = numpy.memmap(
-    confusion_file, dtype=numpy.float32, shape=(cases, cats), mode='r')
-topindex = numpy.argsort(-predictions, axis=1)
+try:
+    prediction.check(args.outdir, '%s.confusion.db' % args.subset, args.tagged, args.subset)
+except prediction.Stale as e:
+    print("{}; run main.py --confusion again{}".format(e,
+            ", using it anyway" if args.stale_ok else ""), file=sys.stderr)
+    if not args.stale_ok:
+        sys.exit(1)
+predictions = confusion.open_predictions(os.path.join(args.outdir,
+    '%s.confusion.db' % args.subset), cats)[:cases]
+cases = len(predictions)
+truth = numpy.array([labels[f] for f in filenames[:cases]], dtype=numpy.int32)
+ranks = confusion.ranks(predictions, truth)
 
+if args.summary:
+    for index, acc in enumerate(confusion.accuracy(ranks, 10)):
+        print("acc@{}: {:.2f}%".format(index + 1, 100.0 * acc))
+    for true, picked, count in confusion.most_confused(
+            confusion.matrix(predictions, truth), 20):
+        print("{} {} should be {}".format(
+            count, categories[picked], categories[true]))
+    import sys
+    sys.exit(0)
+
+topindex, topscores = confusion.top(predictions, 5)
 for index in range(cases):
     top = topindex[index]
-    topscore = predictions[index][top]
-    correct = labels[filenames[index]]
-    confusion = numpy.where(top == correct)[0][0]
+    topscore = topscores[index]
     print("{} {} should be {}, was {} {}, {} {}, {} {}, {} {}, {} {}".format(
-        confusion,
+        ranks[index],
         filenames[index],
         categories[labels[filenames[index]]],
         categories[top[0]],
@@ -0,0 +1,97 @@
+import collections
+import json
+import lasagne
+import numpy
+import theano
+
+# Theano profiles time and memory per op of the optimized graph, which by
+# then has little to do with the layers it was built from. To map the cost
+# back, every layer's get_output_for is wrapped in a function compiled under
+# a file name of its own, like "<layer 3: Conv2DLayer>". Theano records the
+# stack at the creation of every variable, and carries those traces over to
+# the nodes that replace them when it optimizes the graph, so the file name
+# turns up in the trace of most nodes of the compiled function. Nodes
+# without one are reported as unattributed.
+
+PREFIX = '<layer '
+
+def tag_layers(network):
+    '''Wraps the layers of network; call before building any output.'''
+    theano.config.traceback.limit = max(theano.config.traceback.limit, 32)
+    names = []
+    for k, layer in enumerate(lasagne.layers.get_all_layers(network)):
+        name = '{}: {}'.format(k, type(layer).__name__)
+        if layer.name:
+            name += ' ' + layer.name
+        namespace = {'inner': layer.get_output_for}
+        code = compile('def wrapped(*args, **kwargs):\n'
+                       '    return inner(*args, **kwargs)\n',
+                       PREFIX + name + '>', 'exec')
+        exec(code, namespace)
+        layer.get_output_for = namespace['wrapped']
+        names.append(name)
+    return names
+
+def stats():
+    '''A fresh ProfileStats to pass to theano.function as profile.'''
+    theano.config.profile_memory = True
+    return theano.compile.profiling.ProfileStats(atexit_print=False)
+
+def owner(node):
+    traces = getattr(node.outputs[0].tag, 'trace', None) or []
+    # a trace is a list of frames, or a list of such lists after merges
+    if traces and isinstance(traces[0], tuple):
+        traces = [traces]
+    for trace in traces:
+        # the innermost layer frame is the layer that made the node
+        for frame in reversed(trace):
+            if frame[0].startswith(PREFIX):
+                return frame[0][len(PREFIX):-1]
+    return None
+
+def report(profile, names, batches):
+    '''Sums op time, calls and output memory of a ProfileStats by layer.
+    Returns rows sorted by time, most expensive first.'''
+    shapes = getattr(profile, 'variable_shape', {})
+    rows = collections.OrderedDict((n, {
+        'layer': n, 'seconds': 0.0, 'calls': 0, 'nodes': 0,
+        'output_bytes': 0, 'ops': collections.Counter()})
+        for n in names + ['(unattributed)'])
+    for key, seconds in profile.apply_time.items():
+        node = key[1] if isinstance(key, tuple) else key
+        row = rows[owner(node) or '(unattributed)']
+        row['seconds'] += seconds
+        row['calls'] += profile.apply_callcount.get(key, 0)
+        row['nodes'] += 1
+        row['ops'][type(node.op).__name__] += seconds
+        for var in node.outputs:
+            shape = shapes.get(var)
+            if shape is not None and hasattr(var.type, 'dtype'):
+                row['output_bytes'] += int(numpy.prod(shape)) * \
+                        numpy.dtype(var.type.dtype).itemsize
+    total = sum(r['seconds'] for r in rows.values()) or 1.0
+    result = []
+    for r in rows.values():
+        if not r['nodes']:
+            continue
+        r['share'] = r['seconds'] / total
+        r['seconds_per_batch'] = r['seconds'] / max(batches, 1)
+        r['ops'] = [{'op': op, 'seconds': s}
+                    for op, s in r['ops'].most_common()]
+        result.append(r)
+    result.sort(key=lambda r: -r['seconds'])
+    return result
+
+def write(rows, fname, title):
+    '''Writes rows as fname.json and as a table in fname.txt.'''
+    with open(fname + '.json', 'w') as f:
+        json.dump({'title': title, 'layers': rows}, f, indent=1)
+    with open(fname + '.txt', 'w') as f:
+        f.write(title + '\n\n')
+        f.write('{:>7} {:>10} {:>12} {:>8} {:>12}  {}\n'.format(
+                'share', 'seconds', 's/batch', 'nodes', 'out MB', 'layer (top ops)'))
+        for r in rows:
+            ops = ', '.join(o['op'] for o in r['ops'][:3])
+            f.write('{:>6.1f}% {:>10.4f} {:>12.6f} {:>8} {:>12.1f}  {} ({})\n'.format(
+                    r['share'] * 100, r['seconds'], r['seconds_per_batch'],
+                    r['nodes'], r['output_bytes'] / 2**20, r['layer'], ops))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import os.path
+import sys
+
+# Draws the loss and error plot of a training run. main.py runs this in a
+# process of its own, so that training doesn't wait on matplotlib, and
+# hands it the history as JSON on stdin.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('output', help='png file to write')
+parser.add_argument('-e', '--end', type=int, help='number of epochs in the run', required=True)
+args = parser.parse_args()
+
+history = json.load(sys.stdin)
+training = history['training']
+validation = history['validation']
+end = args.end
+
+import matplotlib
+matplotlib.use('Agg') # avoid the need for X
+import seaborn as sns
+import matplotlib.pyplot as plt
+sns.set(style="ticks", color_codes=True)
+
+fig = plt.figure()
+ax_loss = fig.add_subplot(1, 2, 1)
+ax_err = fig.add_subplot(1, 2, 2)
+
+# styles
+ax_loss.grid(True)
+ax_err.grid(b=True, which='major', color='b', linestyle='-', alpha=0.2)
+ax_err.grid(b=True, which='minor', color='b', linestyle='-', alpha=0.1)
+ax_err.minorticks_on()
+ax_err.grid(True)
+#ax_loss.set_yscale('log')
+#ax_err.set_yscale('log')
+
+# limits
+ax_loss.set_xlim(0, end)
+ax_err.set_xlim(0, end)
+ax_err.set_ylim(0, 1)
+#ax_err.set_ylim(1e-5, 1)
+
+# plot loss
+xend = len(training)+1
+ax_loss.plot(range(1, xend), [dp[0] for dp in training], 'b', marker='o', markersize=4)
+xend = len(validation)+1
+ax_loss.plot(range(1, xend), [dp[0] for dp in validation], 'r--', marker='o', markersize=4)
+ax_loss.legend(['Training loss', 'Validation loss'])
+ax_loss.set_title('Model loss')
+
+# plot error
+xend = len(training)+1
+ax_err.plot(range(1, xend), [1-dp[1] for dp in training], 'b', marker='o', markersize=4)
+ax_err.plot(range(1, xend), [1-dp[2] for dp in training], 'r', marker='o', markersize=4)
+xend = len(validation)+1
+ax_err.plot(range(1, xend), [1-dp[1] for dp in validation], 'y--', marker='s', markersize=4)
+ax_err.plot(range(1, xend), [1-dp[2] for dp in validation], 'm--', marker='s', markersize=4)
+ax_err.legend(['Training exact', 'Training top 5', 'Validation exact', 'Validation top 5'])
+ax_err.set_title('Match error')
+
+import tempfile
+with tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(os.path.abspath(args.output))) as fp:
+    fig.savefig(fp, format='png', dpi=192)
+    plt.close(fig)
+    fp.close()
+    os.rename(fp.name, args.output)
@@ -0,0 +1,93 @@
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Gradient saliency: how much the probability of a target category moves
+# with each input pixel, from one backward pass per image rather than a
+# forward pass per occluded patch. The per-pixel saliency is pooled onto
+# the patches of the occlusion grid and negated, so that, as with the
+# occlusion responses, the regions that matter most have the lowest
+# values, and the result can be stored and viewed just like them.
+#
+#   gradient        the largest absolute gradient over the channels
+#   gradient-input  the absolute sum over the channels of gradient x input
+#   smoothgrad      like gradient, averaged over copies of the image with
+#                   gaussian noise added
+
+MODES = ['gradient', 'gradient-input', 'smoothgrad']
+
+def pool(maps, res=16, pix=23, st=7):
+    '''Averages (n, h, w) maps over every patch of the grid, as an
+    (n, res, res) array.'''
+    windows = sliding_window_view(maps, (pix, pix), axis=(1, 2))
+    return windows[:, :res*st:st, :res*st:st].mean(axis=(-2, -1))
+
+class Saliency(object):
+    '''Maps images to saliency on the occlusion grid with grad_fn, which
+    returns the gradient of the probability of category targets[i] with
+    respect to image i, for a batch of up to batchsize images.'''
+
+    def __init__(self, grad_fn, imshape, batchsize, res=16, pix=23, st=7,
+                 mode='gradient', samples=8, noise=0.15, seed=1):
+        if mode not in MODES:
+            raise ValueError('no saliency mode {}'.format(mode))
+        if (res - 1) * st + pix > min(imshape[1:]):
+            raise ValueError('a {0}x{0} grid of {1} pixel patches {2} apart '
+                    'does not fit in {3}'.format(res, pix, st, imshape))
+        self.grad_fn = grad_fn
+        self.imshape = tuple(imshape)
+        self.batchsize = batchsize
+        self.res = res
+        self.pix = pix
+        self.st = st
+        self.mode = mode
+        self.samples = samples if mode == 'smoothgrad' else 1
+        self.noise = noise
+        self.seed = seed
+        self.rng = numpy.random.RandomState(seed)
+        self.passes = 0
+
+    def geometry(self):
+        geometry = {'res': self.res, 'pix': self.pix, 'st': self.st,
+                    'imshape': list(self.imshape), 'batchsize': self.batchsize,
+                    'mode': self.mode, 'values': 'negated saliency'}
+        if self.mode == 'smoothgrad':
+            geometry.update(samples=self.samples, noise=self.noise,
+                            seed=self.seed)
+        return geometry
+
+    def maps(self, images, targets):
+        '''Per-pixel saliency of images for targets, as (n, h, w).'''
+        if self.mode == 'smoothgrad':
+            spread = self.noise * (images.max(axis=(1, 2, 3)) -
+                                   images.min(axis=(1, 2, 3)))
+            grads = numpy.zeros(images.shape, dtype=numpy.float32)
+            for _ in range(self.samples):
+                noisy = images + self.rng.normal(size=images.shape).astype(
+                        images.dtype) * spread[:, None, None, None]
+                grads += self.grad_fn(noisy, targets)
+                self.passes += len(images)
+            return numpy.abs(grads / self.samples).max(axis=1)
+        grads = self.grad_fn(images, targets)
+        self.passes += len(images)
+        if self.mode == 'gradient-input':
+            return numpy.abs((grads * images).sum(axis=1))
+        return numpy.abs(grads).max(axis=1)
+
+    def run(self, X, columns, outs, scale=None, progress=None):
+        '''Writes into outs[t][i] the negated saliency of image X[i] for
+        category columns[i, t], pooled onto the grid, for the first
+        len(columns) images.'''
+        cases, k = len(columns), self.res * self.res
+        columns = numpy.asarray(columns, dtype=numpy.int32)
+        for start in range(0, cases, self.batchsize):
+            images = X[start:min(start + self.batchsize, cases)]
+            if scale is not None:
+                images = images / numpy.float32(scale)
+            images = numpy.asarray(images, dtype=numpy.float32)
+            n = len(images)
+            for t, out in enumerate(outs):
+                pooled = pool(self.maps(images, columns[start:start+n, t]),
+                              self.res, self.pix, self.st)
+                out[start:start+n] = -pooled.reshape(n, k)
+            if progress is not None:
+                progress.update(start + n)
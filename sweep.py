@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+from pretty import *
+import argparse
+import checkpoint
+import json
+import numpy
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+# Runs a sweep of training runs side by side, each in its own output
+# directory and on its own set of cores. The jobs are read from a JSON file
+# holding a list of objects like
+#
+#   {"name": "slim-m95", "network": "slim", "momentum": 0.95,
+#    "batchsize": 256, "epochs": 20, "cores": 4, "args": ["--keep-last", "3"]}
+#
+# where only network is required. The state of the sweep is kept in
+# sweep.json in the sweep directory, so that running the same command again
+# after a crash picks up where it left off; main.py itself resumes each
+# unfinished job from its last checkpoint.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('jobs', help='JSON file with the list of jobs to run')
+parser.add_argument('-t', '--tagged', help='path to directory containing prepared files', default='tagged/full')
+parser.add_argument('-o', '--outdir', help='directory to hold the output directory of every job', default='sweep')
+parser.add_argument('-c', '--cores', type=int, help='number of cores to share among the jobs', default=os.cpu_count())
+parser.add_argument('-j', '--job-cores', type=int, help='number of cores for a job that does not say', default=4)
+parser.add_argument('--retry', help='run again jobs that failed before', action='store_true')
+parser.set_defaults(retry=False)
+parser.add_argument('--summary', help='only print the summary of the sweep so far', action='store_true')
+parser.set_defaults(summary=False)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_jobs(fname):
+    with open(fname, 'r') as f:
+        jobs = json.load(f)
+    names = set()
+    for job in jobs:
+        job.setdefault('name', job['network'])
+        job['cores'] = max(1, min(job.get('cores', args.job_cores), len(available)))
+        if job['name'] in names:
+            raise ValueError('two jobs are named {}'.format(job['name']))
+        names.add(job['name'])
+    return jobs
+
+def state_name():
+    return os.path.join(args.outdir, 'sweep.json')
+
+def read_state():
+    try:
+        with open(state_name(), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_state(state):
+    with open(state_name() + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.rename(state_name() + '.tmp', state_name())
+
+def command(job):
+    cmd = [sys.executable, os.path.join(here, 'main.py'),
+           '--network', job['network'],
+           '--tagged', os.path.abspath(args.tagged),
+           '--outdir', os.path.abspath(os.path.join(args.outdir, job['name']))]
+    for key, flag in [('batchsize', '-b'), ('momentum', '-m'),
+                      ('epochs', '-e'), ('batch_stop', '-s')]:
+        if key in job:
+            cmd += [flag, str(job[key])]
+    return cmd + [str(a) for a in job.get('args', [])]
+
+def launch(job, cores):
+    outdir = os.path.join(args.outdir, job['name'])
+    os.makedirs(outdir, exist_ok=True)
+    env = dict(os.environ)
+    threads = str(len(cores))
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = threads
+    def pin():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+    log = open(os.path.join(outdir, 'main.log'), 'a')
+    return subprocess.Popen(command(job), cwd=here, env=env,
+            stdout=log, stderr=subprocess.STDOUT, preexec_fn=pin)
+
+def summarize(jobs, state):
+    section("Summary")
+    rows = []
+    for job in jobs:
+        outdir = os.path.join(args.outdir, job['name'])
+        status = state.get(job['name'], {}).get('status', 'queued')
+        epochs, best1, best5 = 0, None, None
+        found = checkpoint.epochs(outdir) if os.path.isdir(outdir) else {}
+        if found:
+            stored = checkpoint.load(found[max(found)], params=False)
+            epochs = stored['epoch'] + 1
+            # epochs recorded as NaN have no validation results
+            validated = [v for v in stored['validation'] if not numpy.isnan(v[1])]
+            if validated:
+                best1 = max(v[1] for v in validated)
+                best5 = max(v[2] for v in validated)
+        rows.append((job['name'], job['network'], status, epochs, best1, best5))
+    fmt = lambda v: '-' if v is None else '{:.2f}%'.format(v * 100)
+    with open(os.path.join(args.outdir, 'summary.tsv'), 'w') as f:
+        f.write('name\tnetwork\tstatus\tepochs\tv1acc\tv5acc\n')
+        for name, network, status, epochs, best1, best5 in rows:
+            f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(name, network, status,
+                    epochs, '' if best1 is None else best1,
+                    '' if best5 is None else best5))
+            task("{} ({}): {}, {} epochs, best {} (v1acc) {} (v5acc)".format(
+                    name, network, status, epochs, fmt(best1), fmt(best5)))
+
+available = list(range(args.cores))
+if hasattr(os, 'sched_getaffinity'):
+    available = sorted(os.sched_getaffinity(0))[:args.cores]
+jobs = load_jobs(args.jobs)
+os.makedirs(args.outdir, exist_ok=True)
+state = read_state()
+
+if args.summary:
+    summarize(jobs, state)
+    sys.exit(0)
+
+section("Scheduling {} jobs on {} cores".format(len(jobs), len(available)))
+queue = []
+for job in jobs:
+    status = state.get(job['name'], {}).get('status')
+    if status == 'done' or (status == 'failed' and not args.retry):
+        subtask("{} is {} already".format(job['name'], status))
+        continue
+    queue.append(job)
+
+free = list(available)
+running = {}
+try:
+    while queue or running:
+        # Start queued jobs in order for as long as they fit.
+        while queue and queue[0]['cores'] <= len(free):
+            job = queue.pop(0)
+            cores, free = free[:job['cores']], free[job['cores']:]
+            task("Starting {} on cores {}".format(job['name'],
+                    ','.join(str(c) for c in cores)))
+            running[job['name']] = (job, cores, launch(job, cores))
+            state[job['name']] = {'status': 'running', 'started': time.time()}
+            write_state(state)
+        time.sleep(1)
+        for name, (job, cores, proc) in list(running.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del running[name]
+            free = sorted(free + cores)
+            status = 'done' if code == 0 else 'failed'
+            state[name].update({'status': status, 'returncode': code,
+                                'finished': time.time()})
+            write_state(state)
+            task("{} {} (exit code {})".format(name, status, code))
+except KeyboardInterrupt:
+    # Leave the interrupted jobs to be resumed next time.
+    section("Interrupted; stopping {} jobs".format(len(running)))
+    for name, (job, cores, proc) in running.items():
+        proc.terminate()
+    for name, (job, cores, proc) in running.items():
+        proc.wait()
+        state[name]['status'] = 'queued'
+    write_state(state)
+    sys.exit(1)
+
+summarize(jobs, state)
@@ -0,0 +1,74 @@
+import json
+import threading
+import time
+
+# Training writes a stream of JSON records, one per line, that says where
+# the time goes: how long each stretch of batches waited on the loader and
+# how long it spent in train_fn, and how long validation, checkpoints and
+# plots took. Every record has the wall-clock time and an event name.
+
+class Telemetry(object):
+    '''Appends records to fname. Batch timings are summed and written once
+    every interval seconds (with interval 0, for every batch). Records may
+    come from any thread.'''
+
+    def __init__(self, fname, interval=10):
+        self.file = open(fname, 'a') if fname else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.batches = 0
+        self.images = 0
+        self.wait = 0
+        self.compute = 0
+
+    def event(self, kind, **fields):
+        if self.file is None:
+            return
+        record = {'time': round(time.time(), 3), 'event': kind}
+        for k, v in fields.items():
+            # numpy scalars don't serialize; plain numbers do
+            record[k] = v.item() if hasattr(v, 'item') else v
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def batch(self, images, wait, compute, **fields):
+        '''Counts one training batch of images that waited wait seconds for
+        its data and took compute seconds to train on.'''
+        self.batches += 1
+        self.images += images
+        self.wait += wait
+        self.compute += compute
+        if time.time() - self.since >= self.interval:
+            self.flush(**fields)
+
+    def flush(self, **fields):
+        # Writes out the batches counted since the last record.
+        if self.batches:
+            elapsed = time.time() - self.since
+            self.event('train', batches=self.batches, images=self.images,
+                    seconds=round(elapsed, 3),
+                    images_per_second=round(self.images / max(elapsed, 1e-9), 1),
+                    data_wait=round(self.wait, 3),
+                    train_fn=round(self.compute, 3), **fields)
+        self.reset()
+
+class Timer(object):
+    '''Context manager that records how long its block took as an event.'''
+
+    def __init__(self, telemetry, kind, **fields):
+        self.telemetry = telemetry
+        self.kind = kind
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.event(self.kind,
+                seconds=round(time.time() - self.start, 3), **self.fields)
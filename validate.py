@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+from pretty import *
+import argparse
+import checkpoint
+import compiled
+import dataset
+import experiment
+import loader
+import networks
+import lasagne
+import theano.tensor as T
+import numpy
+import time
+import os
+import os.path
+
+# Validates the checkpoints of a training run as they appear, so that
+# main.py --async-validation can go straight on to the next epoch. Results
+# are appended to validation.txt in the run's directory, one line per epoch,
+# where main.py picks them up.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--tagged', help='path to directory containing prepared files', default='tagged/full')
+parser.add_argument('-n', '--network', help='name of network experiment', default='base')
+parser.add_argument('-o', '--outdir', help='directory of the training run to validate', required=True)
+parser.add_argument('-b', '--batchsize', type=int, help='size of each mini batch', default=256)
+parser.add_argument('-u', '--until', type=int, help='exit once this many epochs have been validated', default=0)
+parser.add_argument('-p', '--parent', type=int, help='exit once this process is gone and no checkpoints are left', default=None)
+parser.add_argument('--poll', type=float, help='seconds between looks for new checkpoints', default=5)
+parser.add_argument('--prefetch', type=int, help='number of batches to read ahead in the background', default=4)
+parser.add_argument('--no-function-cache', help='compile functions afresh, without the cache', action='store_false', dest='function_cache_on')
+parser.set_defaults(function_cache_on=True)
+args = parser.parse_args()
+
+cropsz = networks.CROPSZ
+
+def alive(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+section("Setup")
+task("Loading data")
+subtask("Loading validation set")
+y_val = dataset.open_labels(args.tagged, "val")
+X_val = dataset.open_images(args.tagged, "val")
+imsz = X_val.shape[-1]
+cats = dataset.read_header(args.tagged, "train")['categories']
+
+task("Building model and compiling functions")
+input_var = T.tensor4('X', dtype=X_val.dtype)
+target_var = T.ivector('y')
+
+# the same graph as main.py, on the center crop, unflipped
+c = int(numpy.floor((imsz - cropsz)/2))
+_, prepared = networks.prepare(input_var, cropsz, (c, c), 1)
+
+if args.network not in networks.names():
+    print("No network {} found.".format(args.network))
+    import sys
+    sys.exit(1)
+network = networks.build(args.network, prepared, cropsz, args.batchsize, cats)
+
+params = lasagne.layers.get_all_params(network, trainable=True)
+saveparams = lasagne.layers.get_all_params(network)
+
+test_prediction = lasagne.layers.get_output(network, deterministic=True)
+test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
+                                                        target_var).mean()
+test_1_acc = T.mean(lasagne.objectives.categorical_accuracy(test_prediction, target_var, top_k=1))
+test_5_acc = T.mean(lasagne.objectives.categorical_accuracy(test_prediction, target_var, top_k=5))
+val_fn = compiled.Function('validate',
+        (args.network, args.batchsize, cropsz, imsz, X_val.dtype.name),
+        [input_var, target_var], [test_loss, test_1_acc, test_5_acc],
+        directory=compiled.default_dir() if args.function_cache_on else None,
+        sources=[__file__, experiment.__file__, networks.__file__])
+
+batches = loader.Prefetcher(X_val, y_val, args.batchsize, depth=args.prefetch)
+
+def restore(mfile):
+    stored = checkpoint.load(mfile)
+    state = stored['params']
+    fileparams = saveparams if stored['format'] >= 1 else params
+    assert len(fileparams) == len(state)
+    for p, v in zip(fileparams, state):
+        p.set_value(v)
+
+def validate(epoch, mfile):
+    task("Validating epoch {}".format(epoch))
+    restore(mfile)
+    val_batches = len(range(0, len(X_val), args.batchsize))
+    val_loss = 0
+    val_acc1 = 0
+    val_acc5 = 0
+    p = progress(val_batches)
+    i = 0
+    for inp, res in batches.batches(range(0, len(X_val), args.batchsize)):
+        loss, acc1, acc5 = val_fn(inp, res)
+        val_loss += loss
+        val_acc1 += acc1
+        val_acc5 += acc5
+        i += 1
+        p.update(i)
+    result = (val_loss/val_batches, val_acc1/val_batches, val_acc5/val_batches)
+    checkpoint.append_results(args.outdir, [(epoch, result)])
+    subtask("{:.2f}% (v1acc) {:.2f}% (v5acc)".format(
+        result[1] * 100, result[2] * 100))
+
+section("Validating checkpoints in {}".format(args.outdir))
+while True:
+    # Look at the parent before listing, so that a checkpoint it wrote
+    # just before exiting is still seen.
+    parent_alive = alive(args.parent)
+    done = checkpoint.read_results(args.outdir)
+    found = checkpoint.epochs(args.outdir)
+    # A checkpoint that is missing while a later one exists was pruned
+    # before it could be validated; don't wait for it.
+    last = max(list(found) + list(done) + [-1])
+    if args.until and all(e in done or (e not in found and e < last)
+                          for e in range(args.until)):
+        break
+    todo = sorted((e, f) for e, f in found.items() if e not in done)
+    if not todo:
+        if not parent_alive:
+            break
+        time.sleep(args.poll)
+        continue
+    # Older checkpoints may be pruned while we work; validate in order and
+    # skip any that have gone.
+    for e, mfile in todo:
+        try:
+            validate(e, mfile)
+        except FileNotFoundError:
+            subtask("Checkpoint for epoch {} is gone".format(e))
@@ -3,8 +3,13 @@
 from progressbar import ProgressBar
 from pretty import *
 import argparse
+import confusion
+import dataset
 import numpy
+import occlusion
+import prediction
 import re
+import sys
 import os
 import os.path
 from scipy import misc
@@ -16,6 +21,8 @@ parser.add_argument('-d', '--devkit', help='devkit directory containing categori
 parser.add_argument('-i', '--images', help='path to images/', default='mp-data/images')
 parser.add_argument('-o', '--outdir', help='directory to save images', default=None)
 parser.add_argument('-n', '--network', help='network for choosing outdir', default='base')
+parser.add_argument('--stale-ok', help='use predictions even if they may not be from the latest checkpoint', action='store_true')
+parser.set_defaults(stale_ok=False)
 parser.add_argument('--serve', help='run http server', action='store_true')
 parser.set_defaults(serve=False)
 args = parser.parse_args()
@@ -27,10 +34,6 @@ if args.outdir is None:
 def peg(ar, t1, t2):
     return numpy.clip((ar - t1) / (t2 - t1), 0, 1)
 
-# regular python argsort, from stack overflow
-def argsort(seq):
-    return sorted(range(len(seq)), key=seq.__getitem__)
-
 # Category labels
 categories = []
 for line in open(os.path.join(args.devkit, 'categories.txt')).readlines():
@@ -38,7 +41,9 @@ for line in open(os.path.join(args.devkit, 'categories.txt')).readlines():
     categories.append(re.sub('^/[a-z]/', '', line.strip().split()[0]))
 cats = len(categories)
 
-def extract_resp_region(resp):
+imsz = dataset.read_header(args.tagged, 'train')['shape'][-1]
+
+def extract_resp_region(resp, geometry):
     avg = numpy.average(resp)
     std = numpy.std(resp)
     respmax = avg + std
@@ -46,12 +51,10 @@ def extract_resp_region(resp):
     resp = numpy.minimum(
             numpy.maximum((respmax - resp) /
             (respmax - respmin + 1e-6), 0), 1)
-    smeared = numpy.zeros([128, 128])
-    smearedd = numpy.ones([128, 128]) * 0.01
-    # Some geometric parameters
-    res = 16
-    pix = 23
-    st = 7
+    smeared = numpy.zeros([imsz, imsz])
+    smearedd = numpy.ones([imsz, imsz]) * 0.01
+    # the geometry the response was measured with
+    res, pix, st = geometry['res'], geometry['pix'], geometry['st']
     for x in range(res):
         for y in range(res):
             smeared[y*st:y*st+pix, x*st:x*st+pix] += resp[y][x]
@@ -67,26 +70,27 @@ def create_response_images(name, subset):
         labels[name] = int(label)
     filenames = [line.strip() for line in open(os.path.join(args.tagged,
             '%s.filenames.txt' % subset)).readlines()]
-    response = numpy.memmap(
-            os.path.join(args.outdir, '%s.response.db' % subset),
-            dtype=numpy.float32, mode='r')
-    response.shape = (response.shape[0] / 256, 16, 16)
-    topresponse = numpy.memmap(
-            os.path.join(args.outdir, '%s.topresponse.db' % subset),
-            dtype=numpy.float32, mode='r')
-    topresponse.shape = (topresponse.shape[0] / 256, 16, 16)
+    def open_response(fname):
+        fname = os.path.join(args.outdir, fname)
+        geometry = occlusion.read_geometry(fname)
+        res = geometry['res']
+        response = numpy.memmap(fname, dtype=numpy.float32, mode='r')
+        response.shape = (response.shape[0] // (res * res), res, res)
+        return response, geometry
+    response, geometry = open_response('%s.response.db' % subset)
+    topresponse, topgeometry = open_response('%s.topresponse.db' % subset)
     cases = response.shape[0]
     p = progress(cases)
     for index in range(cases):
         # Smear the measured response in the way it was collected:
-        # over the image with 16 overlapping blocks with a 6-pixel stride.
-        # the blocks are made larger here to fill the entire 128px image,
+        # over the image in the overlapping blocks it was measured with.
+        # the blocks are made larger here to fill the entire image,
         # and additionally a gaussian blur is added at the end.
-        r = extract_resp_region(response[index])
-        tr = extract_resp_region(topresponse[index])
+        r = extract_resp_region(response[index], geometry)
+        tr = extract_resp_region(topresponse[index], topgeometry)
         # now apply the response to create two images.
-        r3 = numpy.tile(r.reshape([128, 128, 1]), [1, 1, 3])
-        tr3 = numpy.tile(tr.reshape([128, 128, 1]), [1, 1, 3])
+        r3 = numpy.tile(r.reshape([imsz, imsz, 1]), [1, 1, 3])
+        tr3 = numpy.tile(tr.reshape([imsz, imsz, 1]), [1, 1, 3])
         im = misc.imread(os.path.join(args.images, filenames[index]))
         # the "see" image shows where the response was high.
         seegim = numpy.multiply(im, r3)
@@ -162,17 +166,20 @@ def create_eval_html(name, subset):
         labels[name] = int(label)
     filenames = [line.strip() for line in open(os.path.join(args.tagged,
             '%s.filenames.txt' % subset)).readlines()]
-    predictions = numpy.memmap(os.path.join(args.outdir,
-            '%s.confusion.db' % subset), dtype=numpy.float32, mode='r')
-    cases = int(predictions.shape[0] / cats)
-    predictions.shape = (cases, cats)
-    topindex = numpy.argsort(-predictions, axis=1)
-    confusion = []
-    for index in range(cases):
-        top = topindex[index]
-        correct = labels[filenames[index]]
-        confusion.append(numpy.where(top == correct)[0][0])
-    worstfirst = reversed(argsort(confusion))
+    try:
+        prediction.check(args.outdir, '%s.confusion.db' % subset, args.tagged, subset)
+    except prediction.Stale as e:
+        print("{}; run main.py --confusion again{}".format(e,
+                ", using it anyway" if args.stale_ok else ""), file=sys.stderr)
+        if not args.stale_ok:
+            sys.exit(1)
+    predictions = confusion.open_predictions(os.path.join(args.outdir,
+            '%s.confusion.db' % subset), cats)
+    cases = len(predictions)
+    truth = numpy.array([labels[f] for f in filenames[:cases]])
+    ranks = confusion.ranks(predictions, truth)
+    topindex, _ = confusion.top(predictions, 1)
+    worstfirst = numpy.argsort(ranks, kind='stable')[::-1]
     for index in worstfirst:
         top = topindex[index]
         correct = labels[filenames[index]]
@@ -180,7 +187,7 @@ def create_eval_html(name, subset):
         html.append('<tr><td colspan=2>{} ({}) [{}]</td></tr>'.format(
                 filenames[index],
                 index,
-                confusion[index]))
+                ranks[index]))
         html.append('<tr>')
         html.append('<td><img src="resp/chosen/' + filenames[index] + '">')
         html.append('<br>{} ({})<br>{}</td>'.format(